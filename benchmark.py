@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+
+# Benchmarks for the performance sensitive parts of vim-tools.
+#
+# Author: Peter Odding <peter@peterodding.com>
+# Last Change: October 16, 2026
+# URL: http://peterodding.com/code/vim/tools/
+
+"""
+Usage: benchmark.py [OPTIONS] [BENCHMARK ..]
+
+Run one or more benchmarks and report how the run time of the benchmarked code
+scales with the size of its input. When no benchmarks are given all of them
+are run.
+
+Available benchmarks:
+
+  delimiters   deduplication of block delimiters in html2vimdoc
+  corpus       conversion of synthetic documents by html2vimdoc (the size is
+               the number of headings; lists, links, code fragments and
+               preformatted blocks grow with it)
+  fixtures     conversion of real README files by html2vimdoc (the size is
+               the number of times each fixture is repeated)
+  selectors    matching CSS selectors (with combinators and groups) using
+               the bundled soupselect module, one traversal per selector
+               versus one traversal for all selectors versus an index of
+               the document (the size is the number of sections of the
+               generated page)
+
+The conversion benchmarks run each measurement in a child process so that the
+peak memory usage of every input size can be reported as well.
+
+Supported options:
+
+  -s, --sizes=LIST    comma separated list of input sizes
+  -r, --repeat=N      number of times to repeat each measurement (the
+                      fastest run is reported)
+  -d, --depth=N       nesting depth of the lists in the synthetic
+                      documents (defaults to 3)
+  -f, --fixture=FILE  Markdown file to use as a fixture (can be given
+                      more than once, defaults to the README of vim-tools)
+  -h, --help          show this message and exit
+"""
+
+# Standard library modules.
+import getopt
+import logging
+import os
+import re
+import resource
+import sys
+import time
+
+# External dependency, install with:
+#  pip install coloredlogs
+import coloredlogs
+
+# External dependency, install with:
+#   pip install beautifulsoup
+from BeautifulSoup import BeautifulSoup
+
+# Modules included in vim-tools.
+import html2vimdoc
+import libs.soupselect as soupselect
+
+# Initialize the logging subsystem.
+logger = logging.getLogger('benchmark')
+logger.setLevel(logging.INFO)
+logger.addHandler(coloredlogs.ColoredStreamHandler(show_name=True))
+
+# Default input sizes.
+DEFAULT_SIZES = [1000, 2000, 4000, 8000, 16000, 32000, 64000]
+
+# Default input sizes of the (much slower) conversion benchmarks.
+DEFAULT_CONVERSION_SIZES = [10, 20, 40, 80, 160]
+
+# Selectors used by the "selectors" benchmark (like the ones used to strip
+# navigation from scraped manuals).
+SELECTORS = ['div#header', 'ul.menu > li', 'div.nav', 'div.nav + h2',
+             'span.breadcrumbs ~ a', '#footer, #sidebar', 'li > code',
+             'p a[href^="http://example.com/1"]', 'pre ~ p > code', 'h1 + p']
+
+# The README of vim-tools is the default fixture.
+DEFAULT_FIXTURES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'README.md')]
+
+def main():
+    """
+    Command line interface for the benchmarks.
+    """
+    sizes = None
+    repeat = 3
+    depth = 3
+    fixtures = []
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 's:r:d:f:h', ['sizes=',
+            'repeat=', 'depth=', 'fixture=', 'help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__.strip()
+        sys.exit(1)
+    for option, value in options:
+        if option in ('-s', '--sizes'):
+            sizes = [int(n) for n in value.split(',')]
+        elif option in ('-r', '--repeat'):
+            repeat = int(value)
+        elif option in ('-d', '--depth'):
+            depth = int(value)
+        elif option in ('-f', '--fixture'):
+            fixtures.append(value)
+        elif option in ('-h', '--help'):
+            print __doc__.strip()
+            sys.exit(0)
+        else:
+            assert False, "Unknown option"
+    # Silence the progress messages logged by html2vimdoc for every conversion.
+    html2vimdoc.logger.setLevel(logging.WARNING)
+    for name in (arguments or sorted(benchmarks)):
+        if name not in benchmarks:
+            logger.error("Unknown benchmark: %s", name)
+            sys.exit(1)
+        logger.info("Running benchmark: %s", name)
+        if name == 'delimiters':
+            report(name, benchmark_delimiters(sizes or DEFAULT_SIZES, repeat))
+        elif name == 'corpus':
+            report(name, benchmark_corpus(sizes or DEFAULT_CONVERSION_SIZES, repeat, depth))
+        elif name == 'fixtures':
+            for filename in (fixtures or DEFAULT_FIXTURES):
+                report("%s (%s)" % (name, filename),
+                       benchmark_fixture(filename, sizes or DEFAULT_CONVERSION_SIZES, repeat))
+        elif name == 'selectors':
+            for mode in ('separate', 'single', 'index'):
+                report("%s (%s)" % (name, mode),
+                       benchmark_selectors(sizes or DEFAULT_CONVERSION_SIZES, repeat, mode))
+
+def report(name, results):
+    """
+    Print a table with the results of a benchmark. The "relative" column shows
+    the time per unit of input relative to the smallest input; when the
+    benchmarked code scales linearly this number stays close to 1.0. When the
+    results include the peak memory usage (in kilobytes) it's reported in the
+    last column.
+    """
+    print "%s:" % name
+    print "  %10s  %12s  %10s  %14s" % ("size", "seconds", "relative", "peak RSS (KB)")
+    baseline = None
+    for result in results:
+        size, seconds = result[:2]
+        per_unit = seconds / size
+        if baseline is None:
+            baseline = per_unit or 1e-9
+        memory = "%14i" % result[2] if len(result) > 2 else "%14s" % '-'
+        print "  %10i  %12.6f  %10.2f  %s" % (size, seconds, per_unit / baseline, memory)
+
+def measure(function, repeat):
+    """
+    Call the given function a number of times and return the fastest time.
+    """
+    timings = []
+    for i in xrange(repeat):
+        start = time.time()
+        function()
+        timings.append(time.time() - start)
+    return min(timings)
+
+def measure_in_child(function, repeat):
+    """
+    Call the given function a number of times in a child process and return
+    a tuple with the fastest time and the peak memory usage (in kilobytes) of
+    the child process. Because the child process starts out as a copy of the
+    benchmark process the peak memory usage includes the memory already in use
+    by the benchmark (which is the same for all input sizes).
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            seconds = measure(function, repeat)
+            memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(write_end, "%r %i" % (seconds, memory))
+        finally:
+            os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as handle:
+        output = handle.read()
+    os.waitpid(pid, 0)
+    if not output:
+        raise Exception, "Benchmark failed in child process!"
+    seconds, memory = output.split()
+    return float(seconds), int(memory)
+
+def benchmark_corpus(sizes, repeat, depth):
+    """
+    Benchmark ``html2vimdoc.html2vimdoc()`` on synthetic documents generated
+    by ``generate_html()``. The number of headings is given by the input size
+    and the number of links, code fragments and preformatted blocks grows in
+    proportion to it.
+    """
+    results = []
+    for size in sizes:
+        html = generate_html(headings=size, list_depth=depth, links=size * 2,
+                             code_fragments=size * 2, preformatted_blocks=size / 2)
+        seconds, memory = measure_in_child(lambda: html2vimdoc.html2vimdoc(html), repeat)
+        results.append((size, seconds, memory))
+    return results
+
+def benchmark_fixture(filename, sizes, repeat):
+    """
+    Benchmark ``html2vimdoc.html2vimdoc()`` on a real Markdown document that's
+    repeated a number of times (given by the input size).
+    """
+    with open(filename) as handle:
+        text = handle.read()
+    results = []
+    for size in sizes:
+        html = html2vimdoc.markdown_to_html("\n\n".join([text] * size), ['fenced_code'])
+        seconds, memory = measure_in_child(lambda: html2vimdoc.html2vimdoc(html), repeat)
+        results.append((size, seconds, memory))
+    return results
+
+def benchmark_selectors(sizes, repeat, mode):
+    """
+    Benchmark matching ``SELECTORS`` against a page generated by
+    ``generate_page()``. The mode is one of 'separate' (one traversal of the
+    document per selector), 'single' (one traversal for all selectors) or
+    'index' (build a ``soupselect.DocumentIndex`` and use it).
+    """
+    results = []
+    for size in sizes:
+        soup = BeautifulSoup(generate_page(size))
+        if mode == 'separate':
+            function = lambda: [soupselect.select(soup, selector) for selector in SELECTORS]
+        elif mode == 'single':
+            function = lambda: soupselect.select_all(soup, SELECTORS)
+        else:
+            function = lambda: soupselect.select_all(soup, SELECTORS, soupselect.DocumentIndex(soup))
+        results.append((size, measure(function, repeat)))
+    return results
+
+def benchmark_delimiters(sizes, repeat):
+    """
+    Benchmark ``html2vimdoc.deduplicate_delimiters()`` on flattened output
+    containing long runs of adjacent block delimiters, which is the worst
+    case for deduplication.
+    """
+    results = []
+    for size in sizes:
+        output = generate_delimited_output(size)
+        seconds = measure(lambda: html2vimdoc.deduplicate_delimiters(list(output)), repeat)
+        results.append((size, seconds))
+    return results
+
+def generate_delimited_output(size):
+    """
+    Generate a flattened list of rendered text and output delimiters like the
+    one produced by rendering a document with lots of nested blocks.
+    """
+    output = []
+    delimiters = [html2vimdoc.OutputDelimiter('\n'),
+                  html2vimdoc.OutputDelimiter('\n\n'),
+                  html2vimdoc.PreformattedText.start_delimiter,
+                  html2vimdoc.PreformattedText.end_delimiter]
+    for i in xrange(size):
+        if i % 8 == 0:
+            output.append("Text of block %i." % i)
+        else:
+            output.append(delimiters[i % len(delimiters)])
+    return output
+
+def generate_html(**options):
+    """
+    Generate a synthetic HTML document by converting the output of
+    ``generate_markdown()`` to HTML (the keyword arguments are passed on).
+    """
+    return html2vimdoc.markdown_to_html(generate_markdown(**options), ['fenced_code'])
+
+def generate_markdown(headings=10, list_depth=3, links=20, code_fragments=20, preformatted_blocks=5):
+    """
+    Generate a synthetic Markdown document. The links, code fragments (some of
+    which refer to the tags of the headings) and preformatted blocks are
+    distributed evenly over the sections of the document. Each section
+    contains a list nested ``list_depth`` levels deep. The generated document
+    only depends on the arguments so that results are comparable between runs.
+    """
+    sections = []
+    for i in xrange(headings):
+        level = 1 + (i % 3)
+        name = "section_%i" % i
+        lines = ["%s Section %i: `%s()`" % ('#' * level, i, name), ""]
+        # Inline elements of the section.
+        inline = ["Introduction to section %i which is long enough to wrap" % i,
+                  "over a few lines when it's converted to a Vim help file."]
+        for j in xrange(distribute(links, headings, i)):
+            inline.append("See [link %i](http://example.com/%i/%i) for details." % (j, i, j))
+        for j in xrange(distribute(code_fragments, headings, i)):
+            # Refer to the tag of the previous heading (if any).
+            inline.append("Call `section_%i()` or `option_%i_%i`." % (max(0, i - 1), i, j))
+        lines.extend(inline)
+        lines.append("")
+        # A nested list.
+        for depth in xrange(list_depth):
+            indent = "    " * depth
+            lines.append("%s- List item at depth %i of section %i with `code_%i`" % (indent, depth + 1, i, depth))
+            lines.append("%s- Another item at depth %i" % (indent, depth + 1))
+        lines.append("")
+        # Preformatted blocks.
+        for j in xrange(distribute(preformatted_blocks, headings, i)):
+            lines.append("    :call section_%i(%i)" % (i, j))
+            lines.append("    :echo 'preformatted block %i'" % j)
+            lines.append("")
+        sections.append("\n".join(lines))
+    return "\n".join(sections)
+
+def generate_page(size):
+    """
+    Generate a large HTML page like the pages of scraped manuals: the
+    synthetic document generated by ``generate_html()`` (with ``size``
+    headings) with navigation before every heading, surrounded by a header,
+    sidebar and footer.
+    """
+    navigation = ('<div class="nav"><span class="breadcrumbs">Manual</span> '
+                  '<a href="#top">Top</a> <a href="#index">Index</a></div>')
+    menu = ''.join('<li><a href="page%i.html">Page %i</a></li>' % (i, i) for i in xrange(20))
+    html = generate_html(headings=size, list_depth=3, links=size * 2,
+                         code_fragments=size * 2, preformatted_blocks=size / 2)
+    return ''.join(['<html><body><div id="header"><ul class="menu">', menu, '</ul></div>',
+                    '<div id="content">', re.sub(r'(<h[1-6]>)', navigation + r'\1', html), '</div>',
+                    '<div id="sidebar"><ul class="menu">', menu, '</ul></div>',
+                    '<div id="footer">', navigation, '</div></body></html>'])
+
+def distribute(total, parts, index):
+    """
+    Evenly distribute ``total`` items over ``parts`` parts and return the
+    number of items in the part with the given index.
+    """
+    return total / parts + (1 if index < total % parts else 0)
+
+# Names of the available benchmarks.
+benchmarks = ('corpus', 'delimiters', 'fixtures', 'selectors')
+
+if __name__ == '__main__':
+    main()
+
+# vim: ft=python ts=4 sw=4 et
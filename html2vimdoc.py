@@ -3,7 +3,7 @@
 # Convert HTML (and Markdown) documents to Vim help files
 #
 # Author: Peter Odding <peter@peterodding.com>
-# Last Change: June 2, 2013
+# Last Change: October 16, 2026
 # URL: http://peterodding.com/code/vim/tools/
 #
 # Missing features:
@@ -15,12 +15,31 @@
 
 """
 html2vimdoc [OPTIONS] [LOCATION]
+html2vimdoc [OPTIONS] --manifest=FILE | --glob=PATTERN ..
+html2vimdoc [OPTIONS] --manual [--directory=DIR] LOCATION ..
 
 Convert HTML (and Markdown) documents to Vim help files. When LOCATION is given
 it is assumed to be the filename or URL of the input, if --url is given that
 URL will be used, otherwise the script reads from standard input. The generated
 Vim help file is written to standard output.
 
+In batch mode (when --manifest and/or --glob are given) many documents are
+converted using a pool of worker processes. Each line of a manifest file
+contains the pathname of an input document and optionally the pathname of the
+generated help file (separated by whitespace); when no output pathname is
+given the help file is created next to the input with the extension .txt.
+The status and run time of each conversion are reported on standard output
+in the order of the manifest (or sorted by pathname for --glob), regardless
+of the number of worker processes.
+
+In manual mode (when --manual is given) the documents given on the command
+line are treated as the pages of a single manual. The headings of all pages
+are tagged using one global tag index so that links between the pages (and
+code fragments referring to headings on other pages) are converted to Vim
+help file tag references. The pages are combined into one Vim help file
+(written to standard output) or, when --directory is given, converted to a
+family of help files (one per page) in the given directory.
+
 Valid options:
 
   -f, --file=NAME  name of generated help file (embedded
@@ -31,6 +50,20 @@ Valid options:
                    relevant when input is Markdown; the extension
                    'fenced_code' is enabled by default)
   -p, --preview    preview generated Vim help file in Vim
+  -n, --no-cache   don't use (or update) the conversion cache
+  -P, --profile=FILE  report the wall time, number of nodes and peak
+                   memory usage of each stage of the conversion on
+                   standard error and save a JSON record to FILE
+                   (implies --no-cache)
+  -m, --manifest=FILE  convert the documents listed in FILE (batch mode)
+  -g, --glob=PATTERN  convert the documents matching the pattern (batch
+                   mode, can be given more than once)
+  -j, --jobs=N     number of worker processes to use in batch and
+                   manual mode (defaults to the number of CPUs)
+  -M, --manual     convert the given documents as the pages of a
+                   single manual (see above)
+  -d, --directory=DIR  generate one help file per page of the manual
+                   in the given directory
   -v, --verbose    make more noise (a lot of noise)
   -h, --help       show this message and exit
 
@@ -38,6 +71,13 @@ This program tries to produce reasonable output given only an HTML or Markdown
 document as input, but you can change most defaults with the command line
 options listed above.
 
+Converted documents are cached in ~/.cache/html2vimdoc (keyed by the input
+and the conversion options) so that converting an unchanged document again
+is almost free. When a document has changed, the rendered text of its top
+level sections that didn't change is reused from the previous conversion
+(except when the document is read from standard input). The cache is limited
+in size; the least recently used conversions are evicted first.
+
 There are several dependencies that need to be installed to run this program.
 The easiest way to install them is in a Python virtual environment:
 
@@ -54,13 +94,19 @@ The easiest way to install them is in a Python virtual environment:
 
 # Standard library modules.
 import collections
+import contextlib
 import getopt
+import glob
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
+import resource
 import sys
 import textwrap
-import types
+import time
 import urllib
 import urlparse
 
@@ -80,6 +126,13 @@ import libs.soupselect as soupselect
 TEXT_WIDTH = 79
 SHIFT_WIDTH = 2
 
+# Location and maximum size (in bytes) of the conversion cache.
+CACHE_DIRECTORY = '~/.cache/html2vimdoc'
+CACHE_SIZE = 1024 * 1024 * 10
+
+# Maximum number of memoized results of wrap_text().
+WRAP_CACHE_SIZE = 10000
+
 # Initialize the logging subsystem.
 logger = logging.getLogger('html2vimdoc')
 logger.setLevel(logging.INFO)
@@ -92,43 +145,114 @@ def main():
     """
     Command line interface for html2vimdoc.
     """
-    filename, title, url, arguments, preview, markdown_extensions = parse_args(sys.argv[1:])
-    filename, url, text = get_input(filename, url, arguments, markdown_extensions)
-    vimdoc = html2vimdoc(text, title=title, filename=filename, url=url)
-    output = vimdoc.encode('utf-8')
-    logger.info("Done!")
-    if preview:
-        os.popen("gvim -c 'set nomod' -", 'w').write(output)
+    options = parse_args(sys.argv[1:])
+    arguments = options['arguments']
+    if options['manual']:
+        pages = read_pages(arguments, options['markdown_extensions'])
+        if options['directory']:
+            if not os.path.isdir(options['directory']):
+                os.makedirs(options['directory'])
+            for filename, vimdoc in generate_manual_pages(pages, jobs=options['jobs']):
+                pathname = os.path.join(options['directory'], filename)
+                logger.info("Writing %s ..", pathname)
+                with open(pathname, 'w') as handle:
+                    handle.write(vimdoc.encode('utf-8') + "\n")
+        else:
+            filename = options['filename'] or default_output_file(os.path.basename(arguments[0]))
+            write_chunks(sys.stdout, generate_manual(pages, title=options['title'], filename=filename, jobs=options['jobs']))
+            sys.stdout.write("\n")
+        logger.info("Done!")
+        return
+    if options['batch_mode']:
+        # The progress messages of concurrent conversions would be interleaved
+        # and hard to follow, so unless --verbose is given only warnings and
+        # errors are logged (the results are reported afterwards).
+        if logger.level == logging.INFO:
+            logger.setLevel(logging.WARNING)
+        results = convert_batch(options['batch'], markdown_extensions=options['markdown_extensions'],
+                                use_cache=options['use_cache'], jobs=options['jobs'])
+        sys.exit(0 if report_batch(results) else 1)
+    filename, url, text, is_markdown = get_input(options['filename'], options['url'], arguments)
+    use_cache = options['use_cache']
+    profile = options['profile']
+    if profile:
+        trace.record_timings = True
+        use_cache = False
+    # The Vim help file is written incrementally as it's being rendered.
+    chunks = convert_document(text,
+                              markdown_extensions=(options['markdown_extensions'] if is_markdown else None),
+                              cache=(ConversionCache() if use_cache else None),
+                              location=(arguments[0] if arguments else url),
+                              title=options['title'], filename=filename, url=url)
+    if options['preview']:
+        handle = os.popen("gvim -c 'set nomod' -", 'w')
+        write_chunks(handle, chunks)
+        handle.close()
     else:
-        print output
+        write_chunks(sys.stdout, chunks)
+        sys.stdout.write("\n")
+    if profile:
+        sys.stderr.write(trace.format_profile())
+        with open(profile, 'w') as handle:
+            trace.write_profile(handle, arguments[0] if arguments else url)
+    logger.info("Done!")
 
 def parse_args(argv):
     """
-    Parse the command line arguments given to html2vimdoc.
-    """
-    preview = False
-    markdown_extensions = ['fenced_code']
-    filename = ''
-    title = ''
-    url = ''
+    Parse the command line arguments given to html2vimdoc. Returns a dictionary
+    with the options (named after the long options) and the positional
+    arguments. Combinations of options that don't make sense (because some of
+    the options would be ignored) are rejected with a usage error.
+    """
+    options = dict(filename='', title='', url='', arguments=[], preview=False,
+                   markdown_extensions=['fenced_code'], use_cache=True,
+                   profile='', batch=[], batch_mode=False, jobs=None,
+                   manual=False, directory='')
+    patterns = []
+    # The options given on the command line (by their short name).
+    given = set()
     try:
-        options, arguments = getopt.getopt(argv, 'f:t:u:x:pvh', ['file=',
-            'title=', 'url=', 'ext=', 'preview', 'verbose', 'help'])
+        parsed_options, options['arguments'] = getopt.getopt(argv, 'f:t:u:x:pnP:m:g:j:Md:vh', ['file=',
+            'title=', 'url=', 'ext=', 'preview', 'no-cache', 'profile=',
+            'manifest=', 'glob=', 'jobs=', 'manual', 'directory=', 'verbose',
+            'help'])
     except getopt.GetoptError, err:
-        print str(err)
-        print __doc__.strip()
-        sys.exit(1)
-    for option, value in options:
+        usage_error(str(err))
+    for option, value in parsed_options:
         if option in ('-f', '--file'):
-            filename = value
+            options['filename'] = value
+            given.add('-f')
         elif option in ('-t', '--title'):
-            title = value
+            options['title'] = value
+            given.add('-t')
         elif option in ('-u', '--url'):
-            url = value
+            options['url'] = value
+            given.add('-u')
         elif option in ('-x', '--ext'):
-            markdown_extensions.append(value)
+            options['markdown_extensions'].append(value)
         elif option in ('-p', '--preview'):
-            preview = True
+            options['preview'] = True
+            given.add('-p')
+        elif option in ('-n', '--no-cache'):
+            options['use_cache'] = False
+        elif option in ('-P', '--profile'):
+            options['profile'] = value
+            given.add('-P')
+        elif option in ('-m', '--manifest'):
+            options['batch'].extend(parse_manifest(value))
+            options['batch_mode'] = True
+        elif option in ('-g', '--glob'):
+            patterns.append(value)
+            options['batch_mode'] = True
+        elif option in ('-j', '--jobs'):
+            options['jobs'] = int(value)
+            given.add('-j')
+        elif option in ('-M', '--manual'):
+            options['manual'] = True
+            given.add('-M')
+        elif option in ('-d', '--directory'):
+            options['directory'] = value
+            given.add('-d')
         elif option in ('-v', '--verbose'):
             logger.setLevel(logging.DEBUG)
         elif option in ('-h', '--help'):
@@ -136,11 +260,148 @@ def parse_args(argv):
             sys.exit(0)
         else:
             assert False, "Unknown option"
-    return filename, title, url, arguments, preview, markdown_extensions
-
-def get_input(filename, url, args, markdown_extensions):
-    """
-    Get text to be converted from standard input, path name or URL.
+    if options['batch_mode']:
+        unsupported = sorted(given.intersection(('-f', '-t', '-u', '-p', '-P', '-M', '-d')))
+        if unsupported:
+            usage_error("Option(s) %s can't be used in batch mode (--manifest or --glob)!" % ", ".join(unsupported))
+        if options['arguments']:
+            usage_error("Batch mode (--manifest or --glob) doesn't accept locations as arguments!")
+        options['batch'].extend(expand_patterns(patterns))
+        if not options['batch']:
+            # Don't fall back to converting standard input.
+            logger.error("No documents to convert! (the manifest and/or glob patterns didn't match any documents)")
+            sys.exit(1)
+    elif options['manual']:
+        unsupported = given.intersection(('-u', '-p', '-P'))
+        if options['directory']:
+            # The names and titles of the help files are based on the pages.
+            unsupported.update(given.intersection(('-f', '-t')))
+        if unsupported:
+            usage_error("Option(s) %s can't be used in manual mode%s!" % (", ".join(sorted(unsupported)),
+                                                                          " with --directory" if options['directory'] else ""))
+        if not options['arguments']:
+            usage_error("Manual mode requires the locations of one or more pages!")
+    else:
+        if '-d' in given:
+            usage_error("Option -d can only be used in manual mode (--manual)!")
+        if '-j' in given:
+            usage_error("Option -j can only be used in batch or manual mode!")
+        if len(options['arguments']) > 1:
+            usage_error("Only one document can be converted at a time! (use --glob or --manual for several documents)")
+    return options
+
+def usage_error(message):
+    """
+    Report an error in the command line arguments and exit.
+    """
+    print message
+    print __doc__.strip()
+    sys.exit(1)
+
+def parse_manifest(pathname):
+    """
+    Parse a manifest file for batch mode. Returns a list of tuples with the
+    pathnames of an input document and the corresponding Vim help file.
+    Empty lines and lines starting with ``#`` are ignored. Relative pathnames
+    are interpreted relative to the directory containing the manifest.
+    """
+    directory = os.path.dirname(os.path.abspath(pathname))
+    pairs = []
+    with open(pathname) as handle:
+        for line in handle:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                if len(fields) > 2:
+                    raise Exception, "Invalid line in manifest %s: %r" % (pathname, line)
+                input_file = os.path.join(directory, fields[0])
+                if len(fields) == 2:
+                    output_file = os.path.join(directory, fields[1])
+                else:
+                    output_file = default_output_file(input_file)
+                pairs.append((input_file, output_file))
+    return pairs
+
+def expand_patterns(patterns):
+    """
+    Find the documents matching the given glob patterns for batch mode.
+    Returns a list of tuples with the pathnames of an input document and the
+    corresponding Vim help file, sorted by the pathname of the input.
+    """
+    matches = set()
+    for pattern in patterns:
+        matches.update(glob.glob(pattern))
+    return [(pathname, default_output_file(pathname)) for pathname in sorted(matches)]
+
+def default_output_file(pathname):
+    """
+    Get the pathname of the Vim help file generated from the given document.
+    """
+    return os.path.splitext(pathname)[0] + '.txt'
+
+def convert_batch(pairs, markdown_extensions=['fenced_code'], use_cache=True, jobs=None):
+    """
+    Convert many documents to Vim help files using a pool of worker processes.
+    Expects a list of tuples with the pathnames of an input document and the
+    corresponding Vim help file. Returns a list of dictionaries with the
+    results of ``convert_file()`` in the same order as the input.
+    """
+    tasks = [(input_file, output_file, markdown_extensions, use_cache)
+             for input_file, output_file in pairs]
+    logger.info("Converting %i documents ..", len(tasks))
+    return parallel_map(convert_file, tasks, jobs)
+
+def convert_file(task):
+    """
+    Convert a single document in batch mode (runs in a worker process). The
+    name of the help file is derived from the output pathname (just like
+    ``get_input()`` derives it from the input pathname). Errors are reported
+    in the result instead of raised, so that one broken document doesn't
+    abort the whole batch.
+    """
+    input_file, output_file, markdown_extensions, use_cache = task
+    start = time.time()
+    result = dict(input=input_file, output=output_file)
+    try:
+        if os.path.abspath(input_file) == os.path.abspath(output_file):
+            raise Exception, "Refusing to overwrite input document with generated help file!"
+        with open(input_file) as handle:
+            text = handle.read()
+        is_markdown = input_file.lower().endswith(('.md', '.mkd', '.mkdn', '.mdown', '.markdown'))
+        chunks = convert_document(text,
+                                  markdown_extensions=(markdown_extensions if is_markdown else None),
+                                  cache=(ConversionCache() if use_cache else None),
+                                  location=os.path.abspath(input_file),
+                                  filename=os.path.basename(output_file))
+        with atomic_write(output_file) as handle:
+            write_chunks(handle, chunks)
+            handle.write("\n")
+        result['status'] = 'ok'
+    except Exception, e:
+        result['status'] = 'failed'
+        result['error'] = "%s: %s" % (type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+def report_batch(results):
+    """
+    Report the results of ``convert_batch()`` on standard output. Returns True
+    when all documents were converted successfully, False otherwise.
+    """
+    failed = 0
+    for result in results:
+        print "%-6s  %8.3fs  %s -> %s" % (result['status'].upper(), result['seconds'],
+                                         result['input'], result['output'])
+        if result['status'] != 'ok':
+            print "        %s" % result['error']
+            failed += 1
+    print "Converted %i of %i documents in %.3f seconds of processing time." % (
+            len(results) - failed, len(results), sum(r['seconds'] for r in results))
+    return failed == 0
+
+def get_input(filename, url, args):
+    """
+    Get text to be converted from standard input, path name or URL. Also
+    reports whether the text is Markdown (based on the filename extension).
     """
     source = ''
     if not url and not args:
@@ -159,9 +420,8 @@ def get_input(filename, url, args, markdown_extensions):
             # Generate embedded filename from base name of input document.
             filename = os.path.basename(source)
             filename = os.path.splitext(filename)[0] + '.txt'
-    if source.lower().endswith(('.md', '.mkd', '.mkdn', '.mdown', '.markdown')):
-        text = markdown_to_html(text, markdown_extensions)
-    return filename, url, text
+    is_markdown = source.lower().endswith(('.md', '.mkd', '.mkdn', '.mdown', '.markdown'))
+    return filename, url, text, is_markdown
 
 def markdown_to_html(text, markdown_extensions):
     """
@@ -176,42 +436,311 @@ def markdown_to_html(text, markdown_extensions):
     # to the rescue with the aptly named UnicodeDammit class :-).
     return markdown(UnicodeDammit(text).unicode, extensions=markdown_extensions)
 
+def convert_document(text, markdown_extensions=None, cache=None, location='', **options):
+    """
+    Generator that converts a Markdown or HTML document to a Vim help file
+    using ``generate_vimdoc()``. When ``markdown_extensions`` is not None the
+    input is assumed to be Markdown. When a ``ConversionCache`` is given and
+    the same document was converted before using the same options, the
+    cached Vim help file is used (skipping the conversion completely). When
+    the ``location`` (filename or URL) of the input is also given, the
+    unchanged sections of the previous conversion of the document are reused
+    (see ``SectionStore``).
+    """
+    trace.update()
+    document_key = None
+    if cache:
+        key = cache.make_key(text, markdown_extensions=markdown_extensions, **options)
+        vimdoc = cache.get(key)
+        if vimdoc is not None:
+            logger.info("Using cached conversion (%s) ..", key)
+            yield vimdoc
+            return
+        # The sections rendered by the previous conversion of the document
+        # are found using a key that doesn't depend on the contents of the
+        # input.
+        if location:
+            document_key = cache.make_key(location, markdown_extensions=markdown_extensions, **options)
+    if markdown_extensions is not None:
+        with trace.stage('markdown'):
+            text = markdown_to_html(text, markdown_extensions)
+    with open_sections(cache, document_key) as sections:
+        chunks = generate_vimdoc(text, sections=sections, **options)
+        if cache:
+            chunks = cache.put(key, chunks)
+        for text in chunks:
+            yield text
+
+class ConversionCache(object):
+
+    """
+    Persistent cache of converted documents. Entries are keyed by a hash of the
+    input document and the conversion options, so they never have to be
+    invalidated explicitly; the total size of the cache is bounded by evicting
+    the least recently used entries. The cache also stores the rendered
+    sections of the last conversion of each document (see
+    ``SectionStore``).
+    """
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_size=CACHE_SIZE):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        self.fingerprint = converter_fingerprint()
+
+    def make_key(self, text, **options):
+        """
+        Generate a cache key from the input document, the conversion options
+        and the (source code of the) converter itself.
+        """
+        context = hashlib.sha1()
+        context.update(self.fingerprint)
+        context.update(repr((TEXT_WIDTH, SHIFT_WIDTH, sorted(options.items()))))
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        context.update(text)
+        return context.hexdigest()
+
+    def get(self, key):
+        """
+        Get a cached Vim help file. Returns None when the key isn't cached.
+        """
+        pathname = os.path.join(self.directory, '%s.txt' % key)
+        try:
+            with open(pathname) as handle:
+                vimdoc = handle.read().decode('utf-8')
+        except IOError:
+            return None
+        # Mark the entry as recently used (another process may have evicted
+        # the entry since we read it, that's fine).
+        try:
+            os.utime(pathname, None)
+        except OSError:
+            pass
+        return vimdoc
+
+    def put(self, key, chunks):
+        """
+        Generator that passes through the chunks of a Vim help file while
+        saving them in the cache. The entry is only added to the cache once
+        all chunks have been generated.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        pathname = os.path.join(self.directory, '%s.txt' % key)
+        # Don't leave behind partial entries when the conversion fails.
+        with atomic_write(pathname) as handle:
+            for text in chunks:
+                handle.write(text.encode('utf-8'))
+                yield text
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in the
+        configured maximum size.
+        """
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.directory):
+            if filename.endswith(('.txt', '.sections')):
+                pathname = os.path.join(self.directory, filename)
+                # Entries can be evicted concurrently by other processes
+                # (e.g. the workers of a batch conversion).
+                try:
+                    stat = os.stat(pathname)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, pathname))
+                total_size += stat.st_size
+        entries.sort()
+        for mtime, size, pathname in entries:
+            if total_size <= self.max_size:
+                break
+            logger.debug("Evicting %s from conversion cache ..", pathname)
+            try:
+                os.unlink(pathname)
+            except OSError:
+                pass
+            total_size -= size
+
+@contextlib.contextmanager
+def open_sections(cache, key):
+    """
+    Context manager that opens the ``SectionStore`` of a document in the given
+    conversion cache. When the cache or the key is None the context manager
+    gives None (so that sections aren't reused). The rendered sections are
+    only saved when the block finishes without raising an exception.
+    """
+    if not (cache and key):
+        yield None
+        return
+    if not os.path.isdir(cache.directory):
+        os.makedirs(cache.directory)
+    pathname = os.path.join(cache.directory, '%s.sections' % key)
+    with atomic_write(pathname) as handle:
+        sections = SectionStore(pathname, handle)
+        try:
+            yield sections
+        finally:
+            sections.close()
+    cache.evict()
+
+class SectionStore(object):
+
+    """
+    The rendered sections of a document (see ``render_sections()``). Reads the
+    sections of the previous conversion of the document from the cache and
+    writes the sections of the current conversion to the given file handle,
+    both one value at a time, so that the sections never have to be kept in
+    memory. The file contains a line ``=FINGERPRINT`` at the start of each
+    section followed by one line of JSON per rendered value (output
+    delimiters are encoded as lists with one element).
+    """
+
+    def __init__(self, pathname, handle):
+        self.handle = handle
+        self.offsets = {}
+        self.reused = 0
+        self.rendered = 0
+        try:
+            self.previous = open(pathname)
+        except IOError:
+            self.previous = None
+        else:
+            # Index the sections of the previous conversion by fingerprint.
+            while True:
+                offset = self.previous.tell()
+                line = self.previous.readline()
+                if not line:
+                    break
+                if line.startswith('='):
+                    self.offsets[line[1:].strip()] = offset
+            # Mark the entry as recently used.
+            try:
+                os.utime(pathname, None)
+            except OSError:
+                pass
+
+    def get(self, fingerprint):
+        """
+        Generator that yields the rendered values of the section with the given
+        fingerprint from the previous conversion. Returns None when the
+        previous conversion didn't contain the section.
+        """
+        if fingerprint not in self.offsets:
+            return None
+        self.reused += 1
+        return self.read_section(self.offsets[fingerprint])
+
+    def read_section(self, offset):
+        self.previous.seek(offset)
+        self.previous.readline()
+        while True:
+            line = self.previous.readline()
+            if not line or line.startswith('='):
+                break
+            value = json.loads(line)
+            yield OutputDelimiter(value[0]) if isinstance(value, list) else value
+
+    def start_section(self, fingerprint):
+        """
+        Start saving a section of the current conversion.
+        """
+        self.rendered += 1
+        self.handle.write('=%s\n' % fingerprint)
+
+    def add(self, value):
+        """
+        Save a rendered value of the current section.
+        """
+        self.handle.write(json.dumps([value.string] if isinstance(value, OutputDelimiter) else value) + '\n')
+
+    def close(self):
+        if self.previous:
+            self.previous.close()
+            self.previous = None
+
+def converter_fingerprint():
+    """
+    Get a hash of the source code of the converter (this module and the
+    bundled soupselect module), so that cached conversions are invalidated
+    when the converter changes.
+    """
+    context = hashlib.sha1()
+    for module in (__file__, soupselect.__file__):
+        with open(os.path.splitext(module)[0] + '.py') as handle:
+            context.update(handle.read())
+    return context.hexdigest()
+
 def html2vimdoc(html, title='', filename='', url='', content_selector='#content', selectors_to_ignore=[], modeline='vim: ft=help'):
     """
     Convert HTML documents to the Vim help file format.
     """
-    logger.info("Parsing HTML ..")
-    html = decode_hexadecimal_entities(html)
-    tree = BeautifulSoup(html, convertEntities=BeautifulSoup.ALL_ENTITIES)
-    logger.info("Transforming contents ..")
-    title = select_title(tree, title)
-    ignore_comments(tree)
-    ignore_given_selectors(tree, selectors_to_ignore)
-    root = find_root_node(tree, content_selector)
-    simple_tree = simplify_node(root)
-    shift_headings(simple_tree)
-    find_references(simple_tree, url)
+    return u"".join(generate_vimdoc(html, title=title,
+                                    filename=filename, url=url,
+                                    content_selector=content_selector,
+                                    selectors_to_ignore=selectors_to_ignore,
+                                    modeline=modeline))
+
+def generate_vimdoc(html, title='', filename='', url='', content_selector='#content', selectors_to_ignore=[], modeline='vim: ft=help', sections=None):
+    """
+    Convert HTML documents to the Vim help file format. This is a generator
+    that yields chunks of text as soon as they've been rendered, so that the
+    output doesn't have to be kept in memory as a whole. When a
+    ``SectionStore`` is given, unchanged sections are not rendered again (see
+    ``render_sections()``).
+    """
+    trace.update()
+    title, simple_tree = parse_document(html, title, content_selector, selectors_to_ignore)
     # Add an "Introduction" heading to separate the table of contents from the
-    # start of the document text.
-    simple_tree.contents.insert(0, Heading(level=1, contents=[Text(text="Introduction")]))
+    # start of the document text. It's inserted into the tree after the first
+    # group of passes (it shouldn't influence the shifting of headings) but it
+    # must be the first heading to be tagged.
+    introduction = Heading(level=1, contents=[Text(text="Introduction")])
+    tagger = TagHeadings(filename)
+    tagger.visit(introduction)
     logger.info("Tagging document headings ..")
-    tagged_headings = tag_headings(simple_tree, filename)
-    logger.info("Marking internal references (pass 1, before TOC) ..")
-    simple_tree = mark_tags(simple_tree, tagged_headings)
+    with trace.stage('passes', lambda: count_nodes(simple_tree)):
+        run_passes(simple_tree, ShiftHeadings(), FindReferences(url), tagger)
+        simple_tree.contents.insert(0, introduction)
+    for text in render_document(simple_tree, tagger.headings, tagger.tags,
+                                title=title, filename=filename, modeline=modeline,
+                                sections=sections):
+        yield text
+
+def parse_document(html, title='', content_selector='#content', selectors_to_ignore=[]):
+    """
+    Parse an HTML document and convert it to a simplified parse tree. Returns
+    a tuple with the title of the document and the simplified parse tree.
+    """
+    logger.info("Parsing HTML ..")
+    with trace.stage('decode_entities'):
+        html = decode_hexadecimal_entities(html)
+    with trace.stage('parse_html', lambda: count_html_nodes(tree)):
+        tree = BeautifulSoup(html, convertEntities=BeautifulSoup.ALL_ENTITIES)
+    logger.info("Transforming contents ..")
+    with trace.stage('prepare_html', lambda: count_html_nodes(root)):
+        title = select_title(tree, title)
+        ignore_comments(tree)
+        ignore_given_selectors(tree, selectors_to_ignore)
+        root = find_root_node(tree, content_selector)
+    with trace.stage('simplify', lambda: count_nodes(simple_tree)):
+        simple_tree = simplify_node(root)
+    return title, simple_tree
+
+def render_document(simple_tree, headings, tags, title='', filename='', modeline='vim: ft=help', links=None, sections=None):
+    """
+    Generator that renders a simplified parse tree whose headings have been
+    tagged to the Vim help file format. The optional ``links`` argument is
+    passed on to ``finalize_tree()``, the optional ``sections`` argument is
+    passed on to ``render_sections()``.
+    """
     logger.info("Generating table of contents ..")
-    generate_table_of_contents(simple_tree)
-    logger.info("Marking internal references (pass 2, after TOC) ..")
-    simple_tree = mark_tags(simple_tree, tagged_headings)
-    make_parents_explicit(simple_tree)
-    prune_empty_blocks(simple_tree)
-    logger.info("Rendering output ..")
-    vimdoc = simple_tree.render(indent=0)
-    output = list(flatten(vimdoc))
-    logger.debug("Output strings before deduplication: %s", list(unicode(v) for v in output))
-    deduplicate_delimiters(output)
-    logger.debug("Output strings after deduplication: %s", list(unicode(v) for v in output))
-    # Render the final text.
-    vimdoc = u"".join(unicode(v) for v in output)
+    with trace.stage('table_of_contents', lambda: count_nodes(simple_tree)):
+        generate_table_of_contents(simple_tree, headings)
+    logger.info("Marking internal references ..")
+    with trace.stage('finalize', lambda: count_nodes(simple_tree)):
+        finalize_tree(simple_tree, tags, links)
     # Add the first line with the file tag and/or document title?
     if title or filename:
         firstline = []
@@ -219,11 +748,354 @@ def html2vimdoc(html, title='', filename='', url='', content_selector='#content'
             firstline.append("*%s*" % filename)
         if title:
             firstline.append(title)
-        vimdoc = "%s\n\n%s" % ("  ".join(firstline), vimdoc)
+        yield "%s\n\n" % "  ".join(firstline)
+    logger.info("Rendering output ..")
+    with trace.stage('render'):
+        if sections is not None:
+            output = render_sections(simple_tree, sections)
+        else:
+            output = flatten(render_blocks(simple_tree))
+        for text in resolve_delimiters(output):
+            yield unicode(text)
     # Add a mode line at the end of the document.
     if modeline and not modeline.isspace():
-        vimdoc += "\n\n" + modeline
-    return vimdoc
+        yield "\n\n" + modeline
+
+def read_pages(locations, markdown_extensions=['fenced_code']):
+    """
+    Read the pages of a manual (see ``generate_manual()``) from the given
+    filenames and/or URLs. Markdown pages are converted to HTML. Returns a
+    list of tuples with the location and HTML of each page.
+    """
+    pages = []
+    for location in locations:
+        logger.info("Reading input from %s ..", location)
+        # urllib.urlopen() rejects relative pathnames like ./page.html.
+        handle = urllib.urlopen(location) if '://' in location else open(location)
+        text = handle.read()
+        handle.close()
+        if location.lower().endswith(('.md', '.mkd', '.mkdn', '.mdown', '.markdown')):
+            text = markdown_to_html(text, markdown_extensions)
+        pages.append((location, text))
+    return pages
+
+def generate_manual(pages, title='', filename='', content_selector='#content', selectors_to_ignore=[], modeline='vim: ft=help', jobs=None):
+    """
+    Generator that converts a manual consisting of several HTML pages to a
+    single Vim help file. Expects a list of tuples with the location (filename
+    or URL) and HTML of each page. The headings of all pages share one table
+    of contents and one tag index, and links between the pages are converted
+    to tag references. The pages are parsed in parallel (see
+    ``parse_pages()``).
+    """
+    trace.update()
+    documents = parse_pages(pages, content_selector, selectors_to_ignore, jobs)
+    if not title:
+        title = documents[0][0]
+    trees = []
+    for i, (page_title, tree) in enumerate(documents):
+        if not isinstance(tree, BlockLevelSequence):
+            tree = BlockLevelSequence(contents=[tree])
+        # The title of the first page is used as the title of the help file,
+        # the other pages start with a top level heading for their title
+        # (select_title() removed the original heading).
+        if i > 0 and page_title:
+            tree.contents.insert(0, Heading(level=1, contents=[Text(text=page_title)]))
+        # Shift the headings of each page separately, so that the top level
+        # headings of every page end up at level 1.
+        run_passes(tree, ShiftHeadings())
+        trees.append(tree)
+    links = resolve_links(pages, trees)
+    root = BlockLevelSequence(contents=[])
+    for tree in trees:
+        root.contents.extend(tree.contents)
+    introduction = Heading(level=1, contents=[Text(text="Introduction")])
+    tagger = TagHeadings(filename)
+    tagger.visit(introduction)
+    logger.info("Tagging document headings ..")
+    with trace.stage('passes', lambda: count_nodes(root)):
+        run_passes(root, FindReferences(''), tagger)
+        root.contents.insert(0, introduction)
+    for text in render_document(root, tagger.headings, tagger.tags, title=title,
+                                filename=filename, modeline=modeline, links=links):
+        yield text
+
+def generate_manual_pages(pages, content_selector='#content', selectors_to_ignore=[], modeline='vim: ft=help', jobs=None):
+    """
+    Convert a manual consisting of several HTML pages to a family of Vim help
+    files (one per page). Expects the same input as ``generate_manual()``.
+    Returns a list of tuples with the filename and contents of each help
+    file. The headings of all pages are tagged using one
+    global tag index (Vim help file tags are global anyway) so that links and
+    code fragments referring to other pages become tag references. The pages
+    are parsed and rendered in parallel.
+    """
+    trace.update()
+    documents = parse_pages(pages, content_selector, selectors_to_ignore, jobs)
+    filenames = manual_filenames([location for location, html in pages])
+    titles = []
+    trees = []
+    for page_title, tree in documents:
+        if not isinstance(tree, BlockLevelSequence):
+            tree = BlockLevelSequence(contents=[tree])
+        run_passes(tree, ShiftHeadings())
+        titles.append(page_title)
+        trees.append(tree)
+    # Links to a page refer to the tag on the first line of its help file.
+    links = resolve_links(pages, trees, dict((location, filename) for (location, html), filename
+                                             in zip(pages, filenames)))
+    # Tag the headings of the pages in order (so that the selected tags don't
+    # depend on the number of worker processes).
+    tags = {}
+    rendered_pages = []
+    for filename, page_title, tree in zip(filenames, titles, trees):
+        introduction = Heading(level=1, contents=[Text(text="Introduction")])
+        tagger = TagHeadings(filename, tags=tags)
+        tagger.visit(introduction)
+        run_passes(tree, FindReferences(''), tagger)
+        tree.contents.insert(0, introduction)
+        rendered_pages.append((filename, tree, tagger.headings, page_title))
+    # Rendering doesn't change the tag index so the pages can be rendered in
+    # parallel by worker processes that inherit the parsed pages.
+    global manual_pages
+    manual_pages = (rendered_pages, tags, links, modeline)
+    try:
+        results = parallel_map(render_manual_page, range(len(rendered_pages)), jobs)
+    finally:
+        manual_pages = None
+    return results
+
+def manual_filenames(locations):
+    """
+    Get the names of the Vim help files generated from the pages of a manual
+    by ``generate_manual_pages()``. The names are based on the base names of
+    the pages, unless two pages have the same base name (e.g. ``a/index.html``
+    and ``b/index.html``) in which case the names are based on the pathnames
+    relative to the common parent directory (``a-index.txt`` and
+    ``b-index.txt``).
+    """
+    filenames = [default_output_file(os.path.basename(location)) for location in locations]
+    if len(set(filenames)) < len(filenames):
+        pathnames = [urlparse.urlparse(location).path if '://' in location else os.path.abspath(location)
+                     for location in locations]
+        parent = os.path.dirname(os.path.commonprefix(pathnames))
+        filenames = [default_output_file(os.path.relpath(pathname, parent).replace(os.sep, '-'))
+                     for pathname in pathnames]
+        if len(set(filenames)) < len(filenames):
+            raise Exception, "Two or more pages of the manual map to the same help file! (%s)" % ", ".join(locations)
+    return filenames
+
+def render_manual_page(index):
+    """
+    Render one page of a manual prepared by ``generate_manual_pages()``. Runs
+    in a worker process (forked after the pages were prepared). Returns a
+    tuple with the filename and the contents of the help file.
+    """
+    rendered_pages, tags, links, modeline = manual_pages
+    filename, tree, headings, title = rendered_pages[index]
+    return filename, u"".join(render_document(tree, headings, tags, title=title,
+                                              filename=filename, modeline=modeline,
+                                              links=links))
+
+def parse_pages(pages, content_selector='#content', selectors_to_ignore=[], jobs=None):
+    """
+    Parse the pages of a manual in parallel using ``parse_document()``.
+    Returns a list of tuples with the title and simplified parse tree of each
+    page (in the order of the pages).
+    """
+    logger.info("Parsing %i pages ..", len(pages))
+    tasks = [(html, '', content_selector, selectors_to_ignore) for location, html in pages]
+    return parallel_map(parse_page, tasks, jobs)
+
+def parse_page(task):
+    """
+    Parse one page of a manual (runs in a worker process).
+    """
+    return parse_document(*task)
+
+def parallel_map(function, arguments, jobs=None):
+    """
+    Apply a function to a list of arguments using a pool of worker processes
+    and return the results in the order of the arguments. When only a single
+    worker process would be used the function is applied in this process.
+    """
+    jobs = min(jobs or multiprocessing.cpu_count(), len(arguments))
+    if jobs <= 1:
+        return map(function, arguments)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        # imap() (unlike imap_unordered()) preserves the order of the tasks.
+        return list(pool.imap(function, arguments))
+    finally:
+        pool.terminate()
+
+def resolve_links(pages, trees, page_tags={}):
+    """
+    Find the hyper links between the pages of a manual. Links to an anchor on
+    a page are resolved to the heading defining the anchor, links to a page
+    are resolved to the tag of the page given by ``page_tags`` (a dictionary
+    with page locations as keys) or otherwise to the first heading of the
+    page. Returns a dictionary that maps each resolved hyper link to the
+    heading or tag it refers to (see ``finalize_tree()``).
+    The targets of the resolved hyper links are cleared so they don't end up
+    in the "References" section; relative links to other documents are made
+    absolute (because the pages can originate from different locations).
+    """
+    # The locations of the pages are normalized so that e.g. ``./page.html``
+    # matches the resolved link ``page.html``.
+    pages = [(normalize_location(location), html) for location, html in pages]
+    page_tags = dict((normalize_location(location), tag) for location, tag in page_tags.iteritems())
+    # Build an index of the anchors defined by the headings of all pages.
+    anchors = {}
+    for (location, html), tree in zip(pages, trees):
+        for heading in walk_tree(tree, Heading):
+            anchors.setdefault((location, ''), heading)
+            for anchor in (heading.anchors or []):
+                anchors.setdefault((location, anchor), heading)
+    locations = set(location for location, html in pages)
+    links = {}
+    for (location, html), tree in zip(pages, trees):
+        base_url = location if '://' in location else ''
+        for node in walk_tree(tree, HyperLink, Image):
+            if isinstance(node, Image):
+                if base_url and node.src:
+                    node.src = urlparse.urljoin(base_url, node.src)
+                continue
+            if not node.target:
+                continue
+            target, fragment = urlparse.urldefrag(urlparse.urljoin(location, node.target))
+            target = normalize_location(target)
+            if target in locations:
+                if fragment:
+                    resolved = anchors.get((target, fragment))
+                else:
+                    resolved = page_tags.get(target) or anchors.get((target, ''))
+                if resolved is not None:
+                    links[node] = resolved
+                # Don't add references to pages of the manual.
+                node.target = ''
+            elif base_url:
+                node.target = urlparse.urljoin(base_url, node.target)
+    logger.debug("Resolved %i links between the pages of the manual.", len(links))
+    return links
+
+def normalize_location(location):
+    """
+    Normalize the location (filename or URL) of a page of a manual so that
+    different spellings of the same local pathname compare equal.
+    """
+    if '://' in location or not location:
+        return location
+    return os.path.normpath(location)
+
+# Global state inherited by the worker processes of generate_manual_pages().
+manual_pages = None
+
+@contextlib.contextmanager
+def atomic_write(pathname, mode='w'):
+    """
+    Context manager that opens a temporary file (in the same directory as the
+    given pathname) for writing and renames the temporary file to the given
+    pathname when the block finishes. When the block raises an exception the
+    temporary file is removed, so a failed conversion never leaves behind a
+    truncated file.
+    """
+    temporary_file = '%s.%i.tmp' % (pathname, os.getpid())
+    try:
+        with open(temporary_file, mode) as handle:
+            yield handle
+        os.rename(temporary_file, pathname)
+    finally:
+        if os.path.exists(temporary_file):
+            os.unlink(temporary_file)
+
+def write_chunks(handle, chunks):
+    """
+    Write the chunks of text generated by ``generate_vimdoc()`` to the given
+    file-like object (encoded as UTF-8).
+    """
+    for text in chunks:
+        handle.write(text.encode('utf-8'))
+
+def render_blocks(root):
+    """
+    Generator that renders the simplified parse tree one top level block at a
+    time (instead of rendering the whole document in one go).
+    """
+    if isinstance(root, BlockLevelSequence):
+        yield root.start_delimiter
+        for node in root.contents:
+            yield join_blocks([node], indent=0)
+        yield root.end_delimiter
+    else:
+        yield join_blocks([root], indent=0)
+
+def render_sections(root, sections):
+    """
+    Generator that renders the simplified parse tree like ``render_blocks()``
+    (but flattened), one top level section at a time. A top level section is
+    a top level heading and the blocks following it. Sections found in the
+    given ``SectionStore`` (by their fingerprint, see ``fingerprint_nodes()``)
+    are not rendered again. Because the fingerprints cover the tags and
+    reference numbers assigned to the nodes, sections are rendered again when
+    a tag or reference elsewhere in the document changes. All sections are
+    saved in the section store while they're being generated.
+    """
+    if not isinstance(root, BlockLevelSequence):
+        for value in flatten(render_blocks(root)):
+            yield value
+        return
+    yield root.start_delimiter
+    for section in split_sections(root.contents):
+        fingerprint = fingerprint_nodes(section)
+        output = sections.get(fingerprint)
+        if output is None:
+            output = flatten(join_blocks([node], indent=0) for node in section)
+        sections.start_section(fingerprint)
+        for value in output:
+            sections.add(value)
+            yield value
+    yield root.end_delimiter
+    logger.info("Reused %i of %i rendered sections.", sections.reused, sections.rendered)
+
+def split_sections(nodes):
+    """
+    Split a list of top level block nodes into sections that start with a
+    top level heading (except the first section, which contains any nodes
+    preceding the first top level heading).
+    """
+    section = []
+    for node in nodes:
+        if isinstance(node, Heading) and node.level == 1 and section:
+            yield section
+            section = []
+        section.append(node)
+    if section:
+        yield section
+
+def fingerprint_nodes(nodes):
+    """
+    Calculate a hash of the fields of the given nodes and their descendants,
+    which covers everything that determines their rendered output.
+    """
+    context = hashlib.sha1()
+    def recurse(value):
+        if isinstance(value, Node):
+            context.update('(%s' % value.__class__.__name__)
+            for name in value.fields:
+                context.update(' %s=' % name)
+                recurse(getattr(value, name))
+            context.update(')')
+        elif isinstance(value, list):
+            context.update('[')
+            for item in value:
+                recurse(item)
+                context.update(',')
+            context.update(']')
+        else:
+            context.update(repr(value))
+    recurse(nodes)
+    return context.hexdigest()
 
 def select_title(tree, title):
     """
@@ -246,52 +1118,91 @@ def select_title(tree, title):
 def deduplicate_delimiters(output):
     """
     Deduplicate redundant block delimiters from the rendered Vim help text.
-    """
-    i = 0
-    while i < len(output) - 1:
-        if isinstance(output[i], OutputDelimiter) and isinstance(output[i + 1], OutputDelimiter):
-            if output[i].string.isspace() and not output[i + 1].string.isspace():
-                output.pop(i)
-                continue
-            elif output[i + 1].string.isspace() and not output[i].string.isspace():
-                output.pop(i + 1)
-                continue
-            elif len(output[i].string) < len(output[i + 1].string):
-                output.pop(i)
-                continue
-            elif len(output[i].string) > len(output[i + 1].string):
-                output.pop(i + 1)
-                continue
-            elif output[i].string.isspace():
-                output.pop(i)
-                continue
-        i += 1
-    # Strip leading block delimiters.
-    while output and isinstance(output[0], OutputDelimiter) and output[0].string.isspace():
-        output.pop(0)
+    The given list is modified in place using a single pass over the list
+    (see ``resolve_delimiters()``).
+    """
+    output[:] = list(resolve_delimiters(output))
+
+def resolve_delimiters(output):
+    """
+    Generator that deduplicates redundant block delimiters in a stream of
+    rendered text and output delimiters. Of two adjacent delimiters, a
+    delimiter that isn't whitespace wins from one that is, otherwise the
+    longer delimiter wins and duplicate whitespace is collapsed. Whitespace
+    delimiters at the start and end of the output are stripped. Because
+    this only needs to look ahead until the next piece of rendered text it
+    runs in linear time and works on streams.
+    """
+    pending = None
+    at_start = True
+    for value in output:
+        if isinstance(value, OutputDelimiter):
+            if pending is None:
+                pending = value
+            elif pending.string.isspace() and not value.string.isspace():
+                pending = value
+            elif value.string.isspace() and not pending.string.isspace():
+                pass
+            elif len(pending.string) < len(value.string):
+                pending = value
+            elif len(pending.string) > len(value.string):
+                pass
+            elif pending.string.isspace():
+                pending = value
+            else:
+                at_start = False
+                yield pending
+                pending = value
+        else:
+            if pending is not None:
+                # Strip leading block delimiters.
+                if not (at_start and pending.string.isspace()):
+                    yield pending
+                pending = None
+            at_start = False
+            yield value
     # Strip trailing block delimiters.
-    while output and isinstance(output[-1], OutputDelimiter) and output[-1].string.isspace():
-        output.pop(-1)
+    if pending is not None and not pending.string.isspace():
+        yield pending
 
 def decode_hexadecimal_entities(html):
     """
     Based on my testing BeautifulSoup doesn't support hexadecimal HTML
-    entities, so we have to decode them ourselves :-(
-    """
-    # If we happen to decode an entity into one of these characters, we
-    # should never insert it literally into the HTML because we'll screw
-    # up the syntax.
-    unsafe_to_decode = {
-            '<': '&lt;',
-            '>': '&gt;',
-            '"': '&quot;',
-            "'": '&apos;',
-            '&': '&amp;',
-    }
+    entities, so we have to decode them ourselves :-(. Decimal and named
+    entities are decoded by BeautifulSoup while it parses the document, so
+    documents without hexadecimal entities are returned as is (without
+    copying them). In Unicode documents hexadecimal entities are replaced
+    with the characters they represent, in byte strings (whose encoding
+    isn't known yet) they're replaced with the equivalent decimal entities.
+    """
+    if '&#x' not in html and '&#X' not in html:
+        return html
+    is_unicode = isinstance(html, unicode)
     def decode_entity(match):
-        character = chr(int(match.group(1), 16))
-        return unsafe_to_decode.get(character, character)
-    return re.sub(r'&#x([0-9A-Fa-f]+);', decode_entity, html)
+        codepoint = int(match.group(1), 16)
+        # If we happen to decode an entity into one of these characters, we
+        # should never insert it literally into the HTML because we'll screw
+        # up the syntax.
+        if codepoint in unsafe_to_decode:
+            return unsafe_to_decode[codepoint]
+        if codepoint > sys.maxunicode:
+            # Not a valid code point (for this build of Python).
+            return match.group(0)
+        return unichr(codepoint) if is_unicode else '&#%i;' % codepoint
+    return hexadecimal_entity_pattern.sub(decode_entity, html)
+
+# Compiled regular expression used by decode_hexadecimal_entities().
+hexadecimal_entity_pattern = re.compile(r'&#[xX]([0-9A-Fa-f]+);')
+
+# Replacements for entities that decode to characters which are part of the
+# HTML syntax (see decode_hexadecimal_entities()).
+unsafe_to_decode = {
+        ord('<'): '&lt;',
+        ord('>'): '&gt;',
+        ord('"'): '&quot;',
+        ord("'"): '&apos;',
+        ord('&'): '&amp;',
+}
 
 def find_root_node(tree, selector):
     """
@@ -301,10 +1212,10 @@ def find_root_node(tree, selector):
     ignoring as much fluff as possible (e.g. headers, footers and
     navigation menus included in the original HTML document).
     """
-    # Try to find the root node using a CSS selector provided by the caller.
-    matches = soupselect.select(tree, selector)
-    if matches:
-        return matches[0]
+    # Try to find the root node using a CSS selector provided by the caller
+    # (we only need the first match, so the search stops there).
+    for match in soupselect.compile_selector(selector).iter_matches(tree):
+        return match
     # Otherwise we'll fall back to the <body> element.
     try:
         return tree.html.body
@@ -324,9 +1235,8 @@ def ignore_given_selectors(tree, selectors_to_ignore):
     Remove all HTML elements matching any of the CSS selectors provided by
     the caller from the parse tree generated by BeautifulSoup.
     """
-    for selector in selectors_to_ignore:
-        for element in soupselect.select(tree, selector):
-            element.extract()
+    if selectors_to_ignore:
+        soupselect.extract_all(tree, selectors_to_ignore, soupselect.DocumentIndex(tree))
 
 def simplify_node(html_node):
     """
@@ -336,18 +1246,21 @@ def simplify_node(html_node):
     # First we'll get text nodes out of the way since they're very common.
     if isinstance(html_node, NavigableString):
         internal_node = Text.parse(html_node)
-        logger.debug("Mapping text %r -> %r", html_node, internal_node)
+        if trace.enabled:
+            logger.debug("Mapping text %r -> %r", html_node, internal_node)
         return internal_node
     # Now we deal with all of the known & supported HTML elements.
     name = getattr(html_node, 'name', None)
     if name in name_to_type_mapping:
         mapped_type = name_to_type_mapping[name]
         internal_node = mapped_type.parse(html_node)
-        logger.debug("Mapping HTML element <%s> -> %r", name, internal_node)
+        if trace.enabled:
+            logger.debug("Mapping HTML element <%s> -> %r", name, internal_node)
         return internal_node
     # Finally we improvise, trying not to lose information.
     internal_node = simplify_children(html_node)
-    logger.debug("Not a supported element! Improvising to preserve content.")
+    if trace.enabled:
+        logger.debug("Not a supported element! Improvising to preserve content.")
     return internal_node
 
 def simplify_children(node):
@@ -359,223 +1272,225 @@ def simplify_children(node):
     for child in getattr(node, 'contents', []):
         contents.append(simplify_node(child))
     if is_block_level(contents):
-        logger.debug("Sequence contains some block level elements")
+        if trace.enabled:
+            logger.debug("Sequence contains some block level elements")
         return BlockLevelSequence(contents=contents)
     else:
-        logger.debug("Sequence contains only inline elements")
+        if trace.enabled:
+            logger.debug("Sequence contains only inline elements")
         return InlineSequence(contents=contents)
 
-def shift_headings(root):
-    """
-    Perform an intermediate pass over the simplified parse tree to shift
-    headings in such a way that top level headings have level 1.
-    """
-    # Find the largest headings (lowest level).
-    min_level = None
-    logger.debug("Finding largest headings ..")
-    for node in walk_tree(root, Heading):
-        if min_level is None:
-            min_level = node.level
-        elif node.level < min_level:
-            min_level = node.level
-    if min_level is None:
-        logger.debug("HTML document doesn't contain any headings?")
-        return
-    else:
-        logger.debug("Largest headings have level %i.", min_level)
-    # Shift the headings if necessary.
-    if min_level > 1:
-        to_subtract = min_level - 1
-        logger.debug("Shifting headings by %i levels.", to_subtract)
-        for node in walk_tree(root, Heading):
-            node.level -= to_subtract
-
-def tag_headings(root, filename):
-    """
-    Generate Vim help file tags for headings.
-    """
-    tagged_headings = {}
-    # Use base name of filename of help file as prefix (scope) for tags.
-    prefix = re.sub(r'\.txt$', '', filename)
-    logger.debug("Vim help file name without file extension: %r", prefix)
-    # If the base name ends in a version number, we'll strip it.
-    prefix = re.sub(r'-\d+(\.\d+)*$', '', prefix)
-    logger.debug("Tagging headings using prefix %r ..", prefix)
-    for node in walk_tree(root, Heading):
-        logger.debug("Selecting tag for heading: %s", node)
-        tag = node.tag_heading(tagged_headings, prefix)
-        if tag:
-            logger.debug("Found suitable tag: %s", tag)
-            tagged_headings[tag] = node
-    return tagged_headings
-
-def mark_tags(root, tags):
-    """
-    Mark references to tags defined in the document.
-    """
+def mark_tags(root, tags, fragments):
+    """
+    Mark references to tags defined in the document by replacing code
+    fragments whose text is a tag with tag references. The code fragments are
+    found using a dictionary that maps the text of code fragments to the
+    nodes (collected by ``finalize_tree()``). Only the parents of matching
+    code fragments are changed.
+    """
+    for text in set(fragments).intersection(tags):
+        for node in fragments[text]:
+            parent = node.parent
+            reference = TagReference(text, [Text(text=text)], parent=parent)
+            reference.contents[0].parent = reference
+            if not isinstance(parent.contents, list):
+                parent.contents = list(parent.contents)
+            parent.contents[parent.contents.index(node)] = reference
+    return root
+
+def finalize_tree(root, tags, links=None):
+    """
+    Prepare the simplified parse tree for rendering. A single traversal of the
+    tree adds links from child nodes to parent nodes, prunes empty block level
+    nodes and collects the code fragments for ``mark_tags()``. The list of
+    child nodes of a node is only replaced when something changed. The
+    optional ``links`` dictionary maps hyper links to headings or tags (see
+    ``resolve_links()``); these hyper links are replaced with references to
+    the tags.
+    """
+    fragments = collections.defaultdict(list)
     def recurse(node, parent):
-        if isinstance(node, CodeFragment) and node.text in tags:
-            return TagReference(node.text, [Text(text=node.text)], parent=node.parent)
-        if isinstance(node, SequenceNode):
-            new_contents = []
-            for child in node:
-                new_contents.append(recurse(child, node))
-            node.contents = new_contents
-        return node
-    return recurse(root, None)
-
-def find_references(root, url):
-    """
-    Scan the document tree for hyper links. Each hyper link is given a unique
-    number so that it can be referenced inside the Vim help file. A new section
-    is appended to the tree which lists an overview of all references to hyper
-    links extracted from the HTML document.
-    """
-    # Mapping of hyper link targets to "Reference" objects.
-    by_target = {}
-    # Ordered list of "Reference" objects.
-    by_reference = []
-    logger.debug("Scanning parse tree for hyper links and other references ..")
-    for node in walk_tree(root, (HyperLink, Image)):
-        if isinstance(node, Image):
-            target = node.src
-        else:
-            target = node.target
-        if not target:
-            continue
-        if target == 'http://www.vim.org/':
-            # Don't add a reference to the Vim homepage in Vim help files.
-            continue
-        if target.startswith('http://vimdoc.sourceforge.net/htmldoc/'):
-            # Don't add a reference to the online Vim documentation.
-            continue
-        # Try to convert relative URLs into absolute URLs.
-        if url and not re.match(r'^\w+:', target):
-            target = urlparse.urljoin(url, target)
-        # Now try to convert absolute URLs into relative URLs... This does
-        # actually make sense, but it sure sounds stupid :-p. All it really
-        # does is normalize URLs to a common format.
-        relative_target = target
-        if url:
-            relative_target = os.path.relpath(target, url)
-        if relative_target.startswith('#'):
-            # Skip links to page anchors on the same page.
-            continue
-        # Exclude literal URLs from list of references.
-        if target.replace('mailto:', '') == node.render(indent=0):
-            continue
-        # Make sure we don't duplicate references.
-        if target in by_target:
-            r = by_target[target]
-        else:
-            number = len(by_reference) + 1
-            logger.debug("Extracting reference #%i to %s ..", number, target)
-            r = Reference(number=number, target=target)
-            by_reference.append(r)
-            by_target[target] = r
-        node.reference = r
-    logger.debug("Found %i references.", len(by_reference))
-    if by_reference:
-        logger.debug("Generating 'References' section ..")
-        root.contents.append(Heading(level=1, contents=[Text(text="References")]))
-        root.contents.extend(by_reference)
+        node.parent = parent
+        if isinstance(node, CodeFragment):
+            fragments[node.text].append(node)
+        elif isinstance(node, SequenceNode):
+            contents = node.contents
+            # Nested sequences are flattened (they're iterated as one).
+            new_contents = None if isinstance(contents, list) else []
+            for i, child in enumerate(node):
+                original = child
+                if links and isinstance(child, HyperLink) and child in links:
+                    tag = links[child]
+                    if isinstance(tag, Heading):
+                        tag = tag.tag
+                    if tag is not None:
+                        child = TagReference(tag, child.contents)
+                if isinstance(child, Node):
+                    recurse(child, node)
+                keep = bool(child)
+                if new_contents is None and (child is not original or not keep):
+                    new_contents = contents[:i]
+                if new_contents is not None and keep:
+                    new_contents.append(child)
+            if new_contents is not None:
+                node.contents = new_contents
+    recurse(root, None)
+    mark_tags(root, tags, fragments)
 
-def generate_table_of_contents(root):
+def generate_table_of_contents(root, headings=None):
     """
     Generate a table of contents for the Vim help file based on the headings
-    defined in the Markdown or HTML document provided by the user.
+    defined in the Markdown or HTML document provided by the user. If the
+    caller already has a list of the headings in document order it can be
+    passed as the second argument (to avoid another traversal of the tree).
     """
     entries = []
     counters = []
-    for heading in walk_tree(root, Heading):
-        logger.debug("Stack of counters before reset: %s", counters)
+    if headings is None:
+        headings = walk_tree(root, Heading)
+    for heading in headings:
         # Forget no longer relevant counters.
         counters = counters[:heading.level]
-        logger.debug("Stack of counters after reset: %s", counters)
         # Make the stack of counters big enough.
         while len(counters) < heading.level:
             counters.append(1)
-        logger.debug("Stack of counters after padding: %s", counters)
+        if trace.enabled:
+            logger.debug("Stack of counters for heading: %s", counters)
         entries.append(TableOfContentsEntry(
             indent=heading.level,
             number=counters[heading.level - 1],
             contents=copy(heading.contents),
-            tag=getattr(heading, 'tag', None)))
+            tag=heading.tag,
+            references_tag=references_tag(heading)))
         counters[heading.level - 1] += 1
-    for i, entry in enumerate(entries, start=1):
-        logger.debug("Table of contents entry %i: %s", i, entry)
+    if trace.enabled:
+        for i, entry in enumerate(entries, start=1):
+            logger.debug("Table of contents entry %i: %s", i, entry)
     root.contents.insert(0, Heading(level=1, contents=[Text(text="Contents")]))
     root.contents.insert(1, BlockLevelSequence(contents=entries))
 
+def references_tag(heading):
+    """
+    Check whether the text of a heading will contain a literal reference to
+    the heading's tag (after ``mark_tags()``).
+    """
+    if heading.tag is not None:
+        for node in walk_tree(heading, CodeFragment, TagReference):
+            if (node.text if isinstance(node, CodeFragment) else node.tag) == heading.tag:
+                return True
+    return False
+
 def copy(node):
     """
-    Copy a subtree, breaking references to the old position in the tree.
+    Copy a subtree (a node or a list of nodes), breaking references to the
+    old position in the tree. See ``Node.clone()``.
     """
     if isinstance(node, list):
-        return map(copy, node)
+        return [copy(n) for n in node]
     elif isinstance(node, Node):
-        attributes = {}
-        for name in dir(node):
-            value = getattr(node, name)
-            # Ignore private attributes.
-            if name.startswith('_'):
-                logger.debug("Ignoring private attribute: %s", name)
-                continue
-            # Ignore methods reported by 'dir'.
-            if isinstance(value, types.MethodType):
-                logger.debug("Ignoring non-attribute: %s", name)
-                continue
-            # Copy only child nodes, never parent nodes.
-            if 'parent' in name:
-                logger.debug("Ignoring parent node attribute: %s", name)
-                continue
-            # Copy attribute value.
-            logger.debug("Copying attribute %s ..", name)
-            attributes[name] = copy(getattr(node, name))
-        # Instantiate the new object.
-        return node.__class__(**attributes)
+        return node.clone()
     else:
         return node
 
-def prune_empty_blocks(root):
+def count_nodes(root):
     """
-    Prune empty block level nodes from the tree.
+    Count the nodes in a simplified parse tree.
     """
-    def recurse(node):
-        if isinstance(node, SequenceNode):
-            filtered_children = []
-            for child in node:
-                recurse(child)
-                if child:
-                    filtered_children.append(child)
-            node.contents = filtered_children
-    recurse(root)
+    return sum(1 for node in walk_tree(root))
 
-def make_parents_explicit(root):
+def count_html_nodes(html_node):
     """
-    Add links from child nodes to parent nodes.
+    Count the elements and text nodes in a parse tree generated by
+    BeautifulSoup.
     """
-    def recurse(node, parent):
-        if isinstance(node, Node):
-            node.parent = parent
-            for child in getattr(node, 'contents', []):
-                recurse(child, node)
-    recurse(root, None)
+    return 1 + sum(1 for node in html_node.recursiveChildGenerator())
 
 def walk_tree(root, *node_types):
     """
-    Return a list of nodes (optionally filtered by type) ordered by the
+    Generator that yields nodes (optionally filtered by type) ordered by the
     original document order (i.e. the left to right, top to bottom reading
-    order of English text).
+    order of English text). The tree is walked lazily, so callers that stop
+    early don't pay for walking the rest of the tree.
     """
-    ordered_nodes = []
-    def recurse(node):
+    stack = [root]
+    while stack:
+        node = stack.pop()
         if not (node_types and not isinstance(node, node_types)):
-            ordered_nodes.append(node)
-        for child in getattr(node, 'contents', []):
-            recurse(child)
-    recurse(root)
-    return ordered_nodes
+            yield node
+        contents = getattr(node, 'contents', None)
+        if contents is not None:
+            stack.extend(reversed(list(contents)))
+
+# Tracing of the conversion process.
+
+class Tracer(object):
+
+    """
+    Debug output and timing of the stages of a conversion. Debug messages in
+    hot code paths are guarded by the ``enabled`` attribute so that their
+    arguments are never even computed unless debug output is enabled.
+    Because the log level can be changed at any time, ``enabled`` is updated
+    at the start of each conversion. Timings are only kept when
+    ``record_timings`` is True (otherwise they're only logged); in that case
+    the number of nodes after each stage and the peak memory usage of the
+    process are recorded as well.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.enabled = False
+        self.record_timings = False
+        self.timings = []
+
+    def update(self):
+        """
+        Enable or disable tracing based on the level of the logger.
+        """
+        self.enabled = self.logger.isEnabledFor(logging.DEBUG)
+
+    @contextlib.contextmanager
+    def stage(self, name, count_nodes=None):
+        """
+        Context manager that records the wall time of a stage of a conversion.
+        The optional ``count_nodes`` callable is used to count the nodes in
+        the document after the stage (only when timings are recorded, because
+        counting nodes requires walking the document).
+        """
+        start = time.time()
+        yield
+        seconds = time.time() - start
+        if self.record_timings:
+            # On Linux ru_maxrss is reported in kilobytes.
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            self.timings.append(dict(stage=name, seconds=seconds,
+                                     nodes=(count_nodes() if count_nodes else None),
+                                     peak_memory=usage.ru_maxrss))
+        if self.enabled:
+            self.logger.debug("Stage %s took %.4f seconds.", name, seconds)
+
+    def write_profile(self, handle, document):
+        """
+        Write the recorded timings of the given document to a file-like object
+        as a single line of JSON.
+        """
+        handle.write(json.dumps(dict(document=document, stages=self.timings)) + "\n")
+
+    def format_profile(self):
+        """
+        Format the recorded timings as a human readable table.
+        """
+        lines = ["%-20s %10s %10s %12s" % ("Stage", "Seconds", "Nodes", "Peak RSS (KB)")]
+        total = 0
+        for record in self.timings:
+            nodes = record['nodes']
+            lines.append("%-20s %10.4f %10s %12i" % (record['stage'], record['seconds'],
+                                                    '-' if nodes is None else nodes,
+                                                    record['peak_memory']))
+            total += record['seconds']
+        lines.append("%-20s %10.4f" % ("Total", total))
+        return "\n".join(lines) + "\n"
+
+trace = Tracer(logger)
 
 # Objects to encapsulate output text with a bit of state.
 
@@ -590,6 +1505,8 @@ class OutputDelimiter(object):
     currently contained in the function ``deduplicate_delimiters()``.
     """
 
+    __slots__ = ('string',)
+
     def __init__(self, string):
         self.string = string
 
@@ -617,16 +1534,40 @@ def html_element(*element_names):
 class Node(object):
 
     """
-    Abstract superclass for all parse tree nodes.
+    Abstract superclass for all parse tree nodes. Concrete node types declare
+    their fields (which are also their slots) in the class attribute
+    ``fields``, so nodes don't need a ``__dict__``.
     """
 
+    fields = ()
+    __slots__ = ('parent',)
+
     def __init__(self, **kw):
         """
-        Short term hack for prototyping :-).
+        Initialize a node from keyword arguments named after its fields.
+        Fields that aren't given default to None.
         """
-        if 'parent' not in kw:
-            kw['parent'] = None
-        self.__dict__ = kw
+        self.parent = kw.pop('parent', None)
+        for name in self.fields:
+            setattr(self, name, kw.pop(name, None))
+        if kw:
+            msg = "%s() got unexpected keyword argument(s): %s"
+            raise TypeError, msg % (self.__class__.__name__, ", ".join(sorted(kw)))
+
+    def clone(self):
+        """
+        Copy the subtree starting at this node. Only the child nodes are
+        copied, the values of other fields (e.g. the reference of a hyper
+        link) are shared with the original node. The copy has no parent.
+        """
+        node = object.__new__(self.__class__)
+        node.parent = None
+        for name in self.fields:
+            value = getattr(self, name)
+            if name == 'contents':
+                value = copy(value)
+            setattr(node, name, value)
+        return node
 
     def __repr__(self):
         """
@@ -657,6 +1598,7 @@ class BlockLevelNode(Node):
     are the nodes which take care of indentation and line wrapping by
     themselves.
     """
+    __slots__ = ()
     start_delimiter = OutputDelimiter('\n\n')
     end_delimiter = OutputDelimiter('\n\n')
 
@@ -666,7 +1608,7 @@ class InlineNode(Node):
     nodes which are subject to indenting and line wrapping by the block level
     nodes that contain them.
     """
-    pass
+    __slots__ = ()
 
 class SequenceNode(Node):
 
@@ -675,6 +1617,8 @@ class SequenceNode(Node):
     nodes.
     """
 
+    __slots__ = ()
+
     @classmethod
     def parse(cls, html_node):
         """
@@ -709,6 +1653,9 @@ class BlockLevelSequence(BlockLevelNode, SequenceNode):
     A sequence of one or more block level nodes.
     """
 
+    fields = ('contents',)
+    __slots__ = fields
+
     def render(self, **kw):
         text = join_blocks(self.contents, **kw)
         return [self.start_delimiter, text, self.end_delimiter]
@@ -723,17 +1670,23 @@ class Heading(BlockLevelNode, SequenceNode):
     document is lost.
     """
 
+    fields = ('level', 'contents', 'tag', 'anchors')
+    __slots__ = fields
+
     @staticmethod
     def parse(html_node):
+        # Remember the anchors defined by the heading (used to resolve links
+        # between the pages of a manual, see resolve_links()).
+        anchors = [a.get('name') or a.get('id') for a in html_node.findAll('a')]
+        anchors.insert(0, html_node.get('id'))
         return Heading(level=int(html_node.name[1]),
-                       contents=simplify_children(html_node))
+                       contents=simplify_children(html_node),
+                       anchors=[a for a in anchors if a])
 
     def tag_heading(self, existing_tags, prefix):
         # Look for a <code> element (indicating a source code
         # entity) whose text has not yet been used as a tag.
-        matches = walk_tree(self, CodeFragment)
-        logger.debug("Found %i code fragments inside heading: %s", len(matches), matches)
-        for node in matches:
+        for node in walk_tree(self, CodeFragment):
             tag = create_tag(node.text, prefix=prefix, is_code=True)
             logger.debug("Checking if %r (from %r) can be used as a tag ..", tag, node.text)
             if tag not in existing_tags:
@@ -741,7 +1694,7 @@ class Heading(BlockLevelNode, SequenceNode):
                 self.tag = tag
                 return tag
         # Fall back to a tag generated from the heading's text.
-        text = join_inline(self.contents, indent=0)
+        text = render_inline(self.contents, indent=0)
         tag = create_tag(text, prefix=prefix, is_code=False)
         logger.debug("Checking if %r (from %r) can be used as a tag ..", tag, text)
         if tag not in existing_tags:
@@ -753,11 +1706,11 @@ class Heading(BlockLevelNode, SequenceNode):
         # We start with a line containing the marker symbol for headings,
         # repeated on the full line. The symbol depends on the level.
         lines = [('=' if self.level == 1 else '-') * TEXT_WIDTH]
-        # Render the heading's text.
-        text = join_inline(self.contents, **kw)
+        # Render the heading's text (it's wrapped below).
+        text = render_inline(self.contents, **kw)
         suffix = ' ~'
         # Add a section tag?
-        if hasattr(self, 'tag'):
+        if self.tag is not None:
             tag = "*%s*" % self.tag
             if self.tag in text:
                 # If the heading references the tag literally, we'll just use
@@ -777,7 +1730,7 @@ class Heading(BlockLevelNode, SequenceNode):
         # heading text and apply the prefix & suffix to each line.
         prefix = ' ' * kw['indent']
         width = TEXT_WIDTH - len(prefix) - len(suffix)
-        lines.extend(prefix + l + suffix for l in textwrap.wrap(text, width=width))
+        lines.extend(prefix + l + suffix for l in wrap_text(text, width=width))
         return [self.start_delimiter, "\n".join(lines), self.end_delimiter]
 
 @html_element('p')
@@ -788,10 +1741,13 @@ class Paragraph(BlockLevelNode, SequenceNode):
     Maps to the HTML element ``<p>``.
     """
 
+    fields = ('contents',)
+    __slots__ = fields
+
     def render(self, **kw):
         # If the paragraph contains only an image (possible wrapped in another
         # element) the paragraph is indented by a minimum of two spaces.
-        if len(self.contents) == 1 and len(walk_tree(self, Image)) == 1:
+        if len(self.contents) == 1 and len(list(walk_tree(self, Image))) == 1:
             kw['indent'] = max(2, kw['indent'])
         return [self.start_delimiter, join_inline(self.contents, **kw), self.end_delimiter]
 
@@ -803,6 +1759,9 @@ class PreformattedText(BlockLevelNode):
     Maps to the HTML element ``<pre>``.
     """
 
+    fields = ('text',)
+    __slots__ = fields
+
     # Vim help file markers for preformatted text.
     start_delimiter = OutputDelimiter('\n>\n')
     end_delimiter = OutputDelimiter('\n<\n')
@@ -842,6 +1801,9 @@ class List(BlockLevelNode, SequenceNode):
     Maps to the HTML elements ``<ol>`` and ``<ul>``.
     """
 
+    fields = ('ordered', 'contents')
+    __slots__ = fields
+
     @staticmethod
     def parse(html_node):
         return List(ordered=(html_node.name=='ol'),
@@ -860,7 +1822,8 @@ class List(BlockLevelNode, SequenceNode):
                     if isinstance(x, basestring):
                         num_lines += x.count('\n')
                 num_lines += 1
-        logger.debug("num_lines=%i, #items=%i, ratio=%.2f", num_lines, len(items), num_lines / float(len(items)))
+        if trace.enabled:
+            logger.debug("num_lines=%i, #items=%i, ratio=%.2f", num_lines, len(items), num_lines / float(len(items)))
         if (num_lines / float(len(items))) > 1.5:
             delimiter = OutputDelimiter('\n\n')
         # Second pass: Combine the delimiters & rendered child nodes.
@@ -880,6 +1843,9 @@ class ListItem(BlockLevelNode, SequenceNode):
     Maps to the HTML element ``<li>``.
     """
 
+    fields = ('contents',)
+    __slots__ = fields
+
     def render(self, number, **kw):
         # Get the original prefix (indent).
         prefix = ' ' * kw['indent']
@@ -919,6 +1885,9 @@ class Table(BlockLevelNode, SequenceNode):
     Maps to the HTML element ``<table>``.
     """
 
+    fields = ('contents',)
+    __slots__ = fields
+
     def render(self, **kw):
         return ''
 
@@ -928,6 +1897,9 @@ class Reference(BlockLevelNode):
     Block level node to represent a reference to a hyper link.
     """
 
+    fields = ('number', 'target')
+    __slots__ = fields
+
     start_delimiter = OutputDelimiter('\n')
     end_delimiter = OutputDelimiter('\n')
 
@@ -941,9 +1913,14 @@ class Reference(BlockLevelNode):
 class TableOfContentsEntry(BlockLevelNode, SequenceNode):
 
     """
-    Block level node to represent a line in the table of contents.
+    Block level node to represent a line in the table of contents. The field
+    ``references_tag`` is True when the text of the entry contains a literal
+    reference to its tag.
     """
 
+    fields = ('indent', 'number', 'contents', 'tag', 'references_tag')
+    __slots__ = fields
+
     start_delimiter = OutputDelimiter('\n')
     end_delimiter = OutputDelimiter('\n')
 
@@ -960,10 +1937,8 @@ class TableOfContentsEntry(BlockLevelNode, SequenceNode):
         text += join_inline(self.contents, indent=0)
         if self.tag:
             # Don't bother including redundant references.
-            for node in walk_tree(self, TagReference):
-                if node.tag == self.tag:
-                    logger.debug("Table of contents entry contains literal reference to tag ..")
-                    break
+            if self.references_tag:
+                logger.debug("Table of contents entry contains literal reference to tag ..")
             else:
                 logger.debug("Table of contents entry doesn't have literal reference to tag; adding it ..")
                 tag = "|%s|" % self.tag
@@ -980,8 +1955,11 @@ class InlineSequence(InlineNode, SequenceNode):
     Inline node to represent a sequence of one or more inline nodes.
     """
 
+    fields = ('contents',)
+    __slots__ = fields
+
     def render(self, **kw):
-        return join_inline(self.contents, **kw)
+        return render_inline(self.contents, **kw)
 
 @html_element('img')
 class Image(InlineNode):
@@ -991,6 +1969,9 @@ class Image(InlineNode):
     Maps to the HTML element ``<img>``.
     """
 
+    fields = ('src', 'alt', 'reference')
+    __slots__ = fields
+
     @staticmethod
     def parse(html_node):
         return Image(src=html_node.get('src', ''),
@@ -1003,7 +1984,7 @@ class Image(InlineNode):
         return "Image(src=%r, alt=%r)" % (self.src, self.alt)
 
     def render(self, **kw):
-        if hasattr(self, 'reference'):
+        if self.reference is not None:
             text = "%s (see reference [%i])" % (self.alt, self.reference.number)
         else:
             text = self.alt or '(unlabeled image)'
@@ -1011,17 +1992,23 @@ class Image(InlineNode):
 
 class TagReference(InlineNode, SequenceNode):
 
+    """
+    Inline node to represent a reference to a Vim help file tag.
+    """
+
+    fields = ('tag', 'contents')
+    __slots__ = fields
+
     def __init__(self, tag, contents, parent=None):
-        self.tag = tag
-        self.contents = contents
-        self.parent = parent
+        super(TagReference, self).__init__(tag=tag, contents=contents, parent=parent)
 
     def __repr__(self):
         return "TagReference(tag=%r, contents=%r)" % (self.tag, self.contents)
 
     def render(self, **kw):
-        logger.debug("About to render: %r", self)
-        text = join_inline(self.contents, **kw)
+        if trace.enabled:
+            logger.debug("About to render: %r", self)
+        text = render_inline(self.contents, **kw)
         parents_which_are_headings = [p for p in self.parents if isinstance(p, Heading)]
         if parents_which_are_headings:
             logger.debug("Omitting tag reference inside heading %s (not valid) ..", parents_which_are_headings[0])
@@ -1041,6 +2028,9 @@ class HyperLink(InlineNode, SequenceNode):
     Maps to the HTML element ``<a>``.
     """
 
+    fields = ('target', 'contents', 'reference')
+    __slots__ = fields
+
     @staticmethod
     def parse(html_node):
         target = html_node.get('href', '')
@@ -1054,21 +2044,20 @@ class HyperLink(InlineNode, SequenceNode):
         return HyperLink(target=target, contents=contents)
 
     def __repr__(self):
-        text = self.render(indent=0)
-        return "HyperLink(text=%r, target=%r, reference=%r)" % (text, self.target, getattr(self, 'reference', None))
+        return "HyperLink(target=%r, reference=%r, contents=%r)" % (self.target, self.reference, self.contents)
 
     def render(self, **kw):
-        images = walk_tree(self, Image)
+        images = list(walk_tree(self, Image))
         if len(self.contents) == 1 and len(images) == 1:
             # If the hyper link contains a single child node which is
             # (or contains) an image, we add a reference for the hyper
             # link but not the image.
             raw_text = "Image: " + images[0].alt
-            text = join_inline([Text(text=raw_text)], **kw)
+            text = render_inline([Text(text=raw_text)], **kw)
         else:
-            text = join_inline(self.contents, **kw)
+            text = render_inline(self.contents, **kw)
         # Add references as needed.
-        if hasattr(self, 'reference'):
+        if self.reference is not None:
             text = "%s [%i]" % (text, self.reference.number)
         return text
 
@@ -1080,6 +2069,9 @@ class CodeFragment(InlineNode):
     Maps to the HTML elements ``<code>`` and ``<tt>``.
     """
 
+    fields = ('text',)
+    __slots__ = fields
+
     @staticmethod
     def parse(html_node):
         return CodeFragment(text=''.join(html_node.findAll(text=True)))
@@ -1112,11 +2104,14 @@ class Emphasis(InlineNode, SequenceNode):
     Maps to the HTML elements ``<i>`` and ``<em>``.
     """
 
+    fields = ('contents',)
+    __slots__ = fields
+
     def __repr__(self):
         return "Emphasis(contents=%r)" % self.contents
 
     def render(self, **kw):
-        return "_%s_" % join_inline(self.contents, **kw)
+        return "_%s_" % render_inline(self.contents, **kw)
 
 @html_element('b', 'strong')
 class Strong(InlineNode, SequenceNode):
@@ -1126,13 +2121,16 @@ class Strong(InlineNode, SequenceNode):
     Maps to the HTML elements ``<b>`` and ``<strong>``.
     """
 
+    fields = ('contents',)
+    __slots__ = fields
+
     def __repr__(self):
         return "Strong(contents=%r)" % self.contents
 
     def render(self, **kw):
         # We use **double** asterisks because a word enclosed in *single*
         # asterisks already has a meaning: It's a help tag definition.
-        return "**%s**" % join_inline(self.contents, **kw)
+        return "**%s**" % render_inline(self.contents, **kw)
 
 class Text(InlineNode):
 
@@ -1140,9 +2138,16 @@ class Text(InlineNode):
     Inline node to represent a sequence of text.
     """
 
+    fields = ('text',)
+    __slots__ = fields
+
     @staticmethod
     def parse(html_node):
-        return Text(text=html_node.string)
+        # Copy the NavigableString to a plain Unicode string (slicing a
+        # subclass of unicode does this without re-encoding entities like
+        # unicode() would) so that the simplified parse tree doesn't refer to
+        # the BeautifulSoup tree.
+        return Text(text=html_node.string[:])
 
     def __repr__(self):
         return "Text(text=%r)" % self.text
@@ -1158,6 +2163,186 @@ class Text(InlineNode):
     def render(self, **kw):
         return self.text
 
+# Passes over the simplified parse tree.
+
+def run_passes(root, *passes):
+    """
+    Run one or more passes over the simplified parse tree using a single
+    traversal of the tree. Each node is given to the passes that are
+    interested in its type, in the order that the passes were given. After
+    the traversal each pass gets a chance to finish its work; new nodes added
+    to the tree by a pass are given to the passes that follow it.
+    """
+    for node in walk_tree(root):
+        for tree_pass in passes:
+            if isinstance(node, tree_pass.node_types):
+                tree_pass.visit(node)
+    for i, tree_pass in enumerate(passes):
+        new_nodes = tree_pass.finish(root) or []
+        logger.debug("Pass %s touched %i node(s).", tree_pass.__class__.__name__, len(tree_pass.touched))
+        for new_node in new_nodes:
+            for node in walk_tree(new_node):
+                for later_pass in passes[i + 1:]:
+                    if isinstance(node, later_pass.node_types):
+                        later_pass.visit(node)
+
+class TreePass(object):
+
+    """
+    Abstract superclass for passes over the simplified parse tree. Passes
+    collect the nodes they're interested in while the tree is being walked
+    and do their actual work in ``finish()``, so that several passes can share
+    a single traversal of the tree (see ``run_passes()``). The nodes that were
+    changed by a pass are recorded in the ``touched`` list.
+    """
+
+    # The types of nodes given to visit().
+    node_types = (Node,)
+
+    def __init__(self):
+        self.touched = []
+
+    def visit(self, node):
+        pass
+
+    def finish(self, root):
+        """
+        Called after the tree has been walked. Returns a list of nodes that
+        were added to the tree (or nothing).
+        """
+        pass
+
+class ShiftHeadings(TreePass):
+
+    """
+    Shift headings in such a way that top level headings have level 1.
+    """
+
+    node_types = (Heading,)
+
+    def __init__(self):
+        super(ShiftHeadings, self).__init__()
+        self.headings = []
+
+    def visit(self, node):
+        self.headings.append(node)
+
+    def finish(self, root):
+        if not self.headings:
+            logger.debug("HTML document doesn't contain any headings?")
+            return
+        # Find the largest headings (lowest level).
+        min_level = min(node.level for node in self.headings)
+        logger.debug("Largest headings have level %i.", min_level)
+        # Shift the headings if necessary.
+        if min_level > 1:
+            to_subtract = min_level - 1
+            logger.debug("Shifting headings by %i levels.", to_subtract)
+            for node in self.headings:
+                node.level -= to_subtract
+                self.touched.append(node)
+
+class TagHeadings(TreePass):
+
+    """
+    Generate Vim help file tags for headings. After the pass has finished,
+    ``tags`` maps tags to headings and ``headings`` contains all headings
+    in document order. To tag several documents using one tag index the
+    same ``tags`` dictionary can be given to several passes.
+    """
+
+    node_types = (Heading,)
+
+    def __init__(self, filename, tags=None):
+        super(TagHeadings, self).__init__()
+        self.headings = []
+        self.tags = {} if tags is None else tags
+        # Use base name of filename of help file as prefix (scope) for tags.
+        prefix = re.sub(r'\.txt$', '', filename)
+        logger.debug("Vim help file name without file extension: %r", prefix)
+        # If the base name ends in a version number, we'll strip it.
+        self.prefix = re.sub(r'-\d+(\.\d+)*$', '', prefix)
+
+    def visit(self, node):
+        self.headings.append(node)
+
+    def finish(self, root):
+        logger.debug("Tagging headings using prefix %r ..", self.prefix)
+        for node in self.headings:
+            logger.debug("Selecting tag for heading: %s", node)
+            tag = node.tag_heading(self.tags, self.prefix)
+            if tag:
+                logger.debug("Found suitable tag: %s", tag)
+                self.tags[tag] = node
+                self.touched.append(node)
+
+class FindReferences(TreePass):
+
+    """
+    Give hyper links and images a unique reference number and append a
+    "References" section to the tree. Each hyper link is given a unique number
+    so that it can be referenced inside the Vim help file.
+    """
+
+    node_types = (HyperLink, Image)
+
+    def __init__(self, url):
+        super(FindReferences, self).__init__()
+        self.url = url
+        # Mapping of hyper link targets to "Reference" objects.
+        self.by_target = {}
+        # Ordered list of "Reference" objects.
+        self.by_reference = []
+
+    def visit(self, node):
+        if isinstance(node, Image):
+            target = node.src
+        else:
+            target = node.target
+        if not target:
+            return
+        if target == 'http://www.vim.org/':
+            # Don't add a reference to the Vim homepage in Vim help files.
+            return
+        if target.startswith('http://vimdoc.sourceforge.net/htmldoc/'):
+            # Don't add a reference to the online Vim documentation.
+            return
+        # Try to convert relative URLs into absolute URLs.
+        if self.url and not re.match(r'^\w+:', target):
+            target = urlparse.urljoin(self.url, target)
+        # Now try to convert absolute URLs into relative URLs... This does
+        # actually make sense, but it sure sounds stupid :-p. All it really
+        # does is normalize URLs to a common format.
+        relative_target = target
+        if self.url:
+            relative_target = os.path.relpath(target, self.url)
+        if relative_target.startswith('#'):
+            # Skip links to page anchors on the same page.
+            return
+        # Exclude literal URLs from list of references.
+        if target.replace('mailto:', '') == node.render(indent=0):
+            return
+        # Make sure we don't duplicate references.
+        if target in self.by_target:
+            r = self.by_target[target]
+        else:
+            number = len(self.by_reference) + 1
+            logger.debug("Extracting reference #%i to %s ..", number, target)
+            r = Reference(number=number, target=target)
+            self.by_reference.append(r)
+            self.by_target[target] = r
+        node.reference = r
+        self.touched.append(node)
+
+    def finish(self, root):
+        logger.debug("Found %i references.", len(self.by_reference))
+        if self.by_reference:
+            logger.debug("Generating 'References' section ..")
+            new_nodes = [Heading(level=1, contents=[Text(text="References")])]
+            new_nodes.extend(self.by_reference)
+            root.contents.extend(new_nodes)
+            return new_nodes
+
 def is_block_level(contents):
     """
     Return True if any of the nodes in the given sequence is a block level
@@ -1192,19 +2377,82 @@ def join_blocks(nodes, **kw):
 
 def join_inline(nodes, **kw):
     """
-    Join a sequence of inline nodes into a single string.
+    Join a sequence of inline nodes into a single string, hard wrapped at the
+    current indentation level. This is where the text of a block level node
+    is wrapped; nested inline nodes are rendered using ``render_inline()``.
     """
     # Render the indentation at the current level.
     prefix = ' ' * kw['indent']
     # Reset the indentation for nested inline nodes.
     kw['indent'] = 0
-    # Render the inline nodes.
-    logger.debug("Inline nodes: %s", nodes)
-    rendered_nodes = [n.render(**kw) for n in nodes]
-    return "\n".join(textwrap.wrap(compact("".join(rendered_nodes)),
-                                   initial_indent=prefix,
-                                   subsequent_indent=prefix,
-                                   width=TEXT_WIDTH - len(prefix)))
+    return "\n".join(wrap_text(render_inline(nodes, **kw),
+                               initial_indent=prefix,
+                               subsequent_indent=prefix,
+                               width=TEXT_WIDTH - len(prefix)))
+
+def render_inline(nodes, **kw):
+    """
+    Render a sequence of inline nodes into a single string with compacted
+    whitespace (without wrapping the text).
+    """
+    if trace.enabled:
+        logger.debug("Inline nodes: %s", nodes)
+    return compact("".join([n.render(**kw) for n in nodes]))
+
+def wrap_text(text, width, initial_indent='', subsequent_indent=''):
+    """
+    Hard wrap compacted text (see ``compact()``) into a list of lines. The
+    result is the same as that of ``textwrap.wrap()`` but it's memoized and
+    text without hyphens is wrapped without textwrap's regular expression
+    based chunking.
+    """
+    key = (text, width, initial_indent, subsequent_indent)
+    lines = wrap_cache.get(key)
+    if lines is None:
+        if '-' not in text:
+            lines = wrap_words(text, width, initial_indent, subsequent_indent)
+        if lines is None:
+            lines = textwrap.wrap(text, width=width,
+                                  initial_indent=initial_indent,
+                                  subsequent_indent=subsequent_indent)
+        if len(wrap_cache) >= WRAP_CACHE_SIZE:
+            wrap_cache.clear()
+        wrap_cache[key] = lines
+    return lines
+
+def wrap_words(text, width, initial_indent, subsequent_indent):
+    """
+    Fast path for ``wrap_text()``: Greedily fill lines with the words of the
+    compacted text. Returns None when a word doesn't fit on a line, in which
+    case textwrap should be used to break the word.
+    """
+    lines = []
+    line = []
+    indent = initial_indent
+    available = width - len(indent)
+    if available <= 0:
+        # Let textwrap report the invalid width.
+        return None
+    length = -1
+    for word in text.split(' '):
+        if len(word) > available:
+            return None
+        if line and length + 1 + len(word) > available:
+            lines.append(indent + ' '.join(line))
+            indent = subsequent_indent
+            available = width - len(indent)
+            if len(word) > available:
+                return None
+            line = []
+            length = -1
+        line.append(word)
+        length += 1 + len(word)
+    if text:
+        lines.append(indent + ' '.join(line))
+    return lines
+
+# Memoized results of wrap_text().
+wrap_cache = {}
 
 def compact(text):
     """
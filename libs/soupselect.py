@@ -10,12 +10,50 @@ select(soup, 'div')
 select(soup, 'div#main ul a')
 - returns a list of links inside a ul inside div#main
 
+select(soup, 'ul.menu > li + li, div.footer ~ p')
+- child (>), adjacent sibling (+) and general sibling (~) combinators and
+  comma separated groups of selectors are supported as well
+
+Selectors are compiled to Selector objects which are cached (by selector
+string) so that using the same selector again doesn't parse it again:
+
+selector = compile_selector('div#main ul a')
+selector.select(soup)
+- same as select(soup, 'div#main ul a')
+
+select_all(soup, ['div.header', 'div.footer'])
+- returns a list of matches for each selector, found in a single traversal
+  of the document
+
+extract_all(soup, ['div.header', 'div.footer'])
+- removes the elements matching any of the selectors from the document
+
+On large documents that are queried many times, an index of the elements by
+tag name, id and class can be built once and given to select(), select_all()
+and extract_all() so that matching elements are found without scanning the
+document:
+
+index = DocumentIndex(soup)
+select(soup, 'div.header a', index=index)
+
 """
 
+import bisect
+import collections
 import re
 
+from BeautifulSoup import Tag
+
+# Maximum number of compiled selectors kept in the cache.
+CACHE_SIZE = 128
+
 tag_re = re.compile('^[a-z0-9]+$')
 
+# A simple selector (attribute values in brackets can contain anything but
+# a closing bracket) and the combinator or comma following it.
+token_re = re.compile(r'(?:[^\s>+~,\[]|\[[^\]]*\])+')
+separator_re = re.compile(r'\s*([>+~,])\s*|\s+')
+
 attribselect_re = re.compile(
     r'^(?P<tag>\w+)?\[(?P<attribute>\w+)(?P<operator>[=~\|\^\$\*]?)' + 
     r'=?"?(?P<value>[^\]"]*)"?\]$'
@@ -29,86 +67,444 @@ attribselect_re = re.compile(
 #     |   Attribute 
 #    Tag
 
+def get_attribute(el, attribute, default=None):
+    """
+    Get the value of an attribute of an element. Unlike el.get() this doesn't
+    search the descendants of the element for an <attrMap> tag the first time
+    it's used on an element (a quirk of BeautifulSoup 3 that makes el.get()
+    very slow on large documents).
+    """
+    for name, value in el.attrs:
+        if name == attribute:
+            return value
+    return default
+
 def attribute_checker(operator, attribute, value=''):
     """
     Takes an operator, attribute and optional value; returns a function that
     will return True for elements that match that combination.
     """
     return {
-        '=': lambda el: el.get(attribute) == value,
+        '=': lambda el: get_attribute(el, attribute) == value,
         # attribute includes value as one of a set of space separated tokens
-        '~': lambda el: value in el.get(attribute, '').split(),
+        '~': lambda el: value in get_attribute(el, attribute, '').split(),
         # attribute starts with value
-        '^': lambda el: el.get(attribute, '').startswith(value),
+        '^': lambda el: get_attribute(el, attribute, '').startswith(value),
         # attribute ends with value
-        '$': lambda el: el.get(attribute, '').endswith(value),
+        '$': lambda el: get_attribute(el, attribute, '').endswith(value),
         # attribute contains value
-        '*': lambda el: value in el.get(attribute, ''),
+        '*': lambda el: value in get_attribute(el, attribute, ''),
         # attribute is either exactly value or starts with value-
-        '|': lambda el: el.get(attribute, '') == value \
-            or el.get(attribute, '').startswith('%s-' % value),
-    }.get(operator, lambda el: el.has_key(attribute))
+        '|': lambda el: get_attribute(el, attribute, '') == value \
+            or get_attribute(el, attribute, '').startswith('%s-' % value),
+    }.get(operator, lambda el: get_attribute(el, attribute) is not None)
 
 
-def select(soup, selector):
+def tag_checker(tag, checker=None):
     """
-    soup should be a BeautifulSoup instance; selector is a CSS selector 
-    specifying the elements you want to retrieve.
+    Takes a tag name (or None for any tag) and an optional function as
+    returned by attribute_checker(); returns a function that will return
+    True for elements that match both.
     """
-    tokens = selector.split()
-    current_context = [soup]
-    for token in tokens:
-        m = attribselect_re.match(token)
-        if m:
-            # Attribute selector
-            tag, attribute, operator, value = m.groups()
-            if not tag:
-                tag = True
-            checker = attribute_checker(operator, attribute, value)
-            found = []
-            for context in current_context:
-                found.extend([el for el in context.findAll(tag) if checker(el)])
-            current_context = found
-            continue
-        if '#' in token:
-            # ID selector
-            tag, id = token.split('#', 1)
-            if not tag:
-                tag = True
-            el = current_context[0].find(tag, {'id': id})
-            if not el:
-                return [] # No match
-            current_context = [el]
-            continue
-        if '.' in token:
-            # Class selector
-            tag, klass = token.split('.', 1)
-            if not tag:
-                tag = True
-            found = []
-            for context in current_context:
-                found.extend(
-                    context.findAll(tag,
-                        {'class': lambda attr: attr and klass in attr.split()}
-                    )
-                )
-            current_context = found
-            continue
-        if token == '*':
-            # Star selector
-            found = []
-            for context in current_context:
-                found.extend(context.findAll(True))
-            current_context = found
-            continue
-        # Here we should just have a regular tag
-        if not tag_re.match(token):
-            return []
+    if tag and checker:
+        return lambda el: el.name == tag and checker(el)
+    elif tag:
+        return lambda el: el.name == tag
+    elif checker:
+        return checker
+    else:
+        return lambda el: True
+
+def compile_token(token):
+    """
+    Takes a single token of a selector (a simple selector); returns a
+    function that will return True for elements that match the token, or
+    None when the token isn't supported.
+    """
+    m = attribselect_re.match(token)
+    if m:
+        # Attribute selector
+        tag, attribute, operator, value = m.groups()
+        return tag_checker(tag, attribute_checker(operator, attribute, value))
+    if '#' in token:
+        # ID selector
+        tag, id = token.split('#', 1)
+        return tag_checker(tag, lambda el: get_attribute(el, 'id') == id)
+    if '.' in token:
+        # Class selector
+        tag, klass = token.split('.', 1)
+        return tag_checker(tag, lambda el: klass in get_attribute(el, 'class', '').split())
+    if token == '*':
+        # Star selector
+        return tag_checker(None)
+    # Here we should just have a regular tag
+    if tag_re.match(token):
+        return tag_checker(token)
+
+def index_key(token):
+    """
+    Takes a single token of a selector; returns a tuple with the kind of key
+    ('name', 'id' or 'class') and the key that can be used to find the
+    candidate elements for the token in a DocumentIndex, or None when all
+    elements are candidates.
+    """
+    m = attribselect_re.match(token)
+    if m:
+        tag = m.group('tag')
+        return ('name', tag) if tag else None
+    if '#' in token:
+        return ('id', token.split('#', 1)[1])
+    if '.' in token:
+        # Classes are usually more selective than tag names.
+        return ('class', token.split('.', 1)[1])
+    if token != '*':
+        return ('name', token)
+
+class DocumentIndex(object):
+
+    """
+    Index of the elements in a document by tag name, id and class. The
+    elements are numbered in document order; together with the position of
+    the last descendant of each element this makes it possible to check
+    whether an element is a descendant of another element without walking
+    the tree. The index isn't updated when the document is changed.
+    """
+
+    def __init__(self, soup):
+        self.soup = soup
+        # Elements in document order.
+        self.elements = []
+        # Mapping of id(element) to the position of the element.
+        self.positions = {}
+        # Position of the last descendant of each element (by position).
+        self.ends = []
+        self.by_key = {'name': collections.defaultdict(list),
+                       'id': collections.defaultdict(list),
+                       'class': collections.defaultdict(list)}
+        stack = [(el, False) for el in reversed(soup.contents) if isinstance(el, Tag)]
+        while stack:
+            el, finished = stack.pop()
+            if finished:
+                self.ends[self.positions[id(el)]] = len(self.elements) - 1
+                continue
+            self.positions[id(el)] = len(self.elements)
+            self.elements.append(el)
+            self.ends.append(None)
+            self.by_key['name'][el.name].append(el)
+            id_value = get_attribute(el, 'id')
+            if id_value is not None:
+                self.by_key['id'][id_value].append(el)
+            for klass in get_attribute(el, 'class', '').split():
+                self.by_key['class'][klass].append(el)
+            stack.append((el, True))
+            stack.extend((child, False) for child in reversed(el.contents) if isinstance(child, Tag))
+
+    def lookup(self, key):
+        """
+        Get the candidate elements for an index key (see index_key()) in
+        document order.
+        """
+        if key is None:
+            return self.elements
+        kind, value = key
+        return self.by_key[kind].get(value, [])
+
+    def descendants(self, ancestors, candidates):
+        """
+        Returns the candidates that are descendants of any of the ancestors
+        (both given in document order) using the positions of the elements.
+        """
+        # Merge the ranges of descendants of the ancestors (nested ancestors
+        # are covered by the range of their outer ancestor).
+        starts = []
+        ends = []
+        for el in ancestors:
+            if el is self.soup:
+                return list(candidates)
+            position = self.positions[id(el)]
+            if not ends or position > ends[-1]:
+                starts.append(position + 1)
+                ends.append(self.ends[position])
         found = []
-        for context in current_context:
-            found.extend(context.findAll(token))
-        current_context = found
-    return current_context
+        for el in candidates:
+            position = self.positions[id(el)]
+            i = bisect.bisect_right(starts, position) - 1
+            if i >= 0 and position <= ends[i]:
+                found.append(el)
+        return found
+
+    def related(self, combinator, elements, candidates):
+        """
+        Returns the candidates that are children ('>'), adjacent siblings
+        ('+') or following siblings ('~') of any of the elements.
+        """
+        ids = set(id(el) for el in elements)
+        if combinator == '~':
+            # Remember the position of the first element for each parent.
+            first = {}
+            for el in elements:
+                first.setdefault(id(el.parent), self.positions[id(el)])
+        found = []
+        for el in candidates:
+            if combinator == '>':
+                related = el.parent is not None and id(el.parent) in ids
+            elif combinator == '+':
+                node = previous_element(el)
+                related = node is not None and id(node) in ids
+            else:
+                position = first.get(id(el.parent))
+                related = position is not None and position < self.positions[id(el)]
+            if related:
+                found.append(el)
+        return found
+
+def parse_selector(selector):
+    """
+    Takes a selector; returns a list of groups (separated by commas) where
+    each group is a list of (combinator, token) tuples. The combinator of the
+    first token of a group is None, the others are ' ', '>', '+' or '~'.
+    Returns None when the selector can't be parsed.
+    """
+    groups = []
+    steps = []
+    combinator = None
+    position = 0
+    selector = selector.strip()
+    while position < len(selector):
+        m = token_re.match(selector, position)
+        if not m:
+            return None
+        steps.append((combinator, m.group()))
+        combinator = None
+        position = m.end()
+        m = separator_re.match(selector, position)
+        if m:
+            position = m.end()
+            if m.group(1) == ',':
+                groups.append(steps)
+                steps = []
+            else:
+                combinator = m.group(1) or ' '
+        elif position < len(selector):
+            return None
+    if not steps or combinator is not None:
+        # Empty selector or group, or a dangling combinator.
+        return None
+    groups.append(steps)
+    return groups
+
+def previous_element(el):
+    """
+    Returns the element preceding the given element at the same level of the
+    document (skipping text), or None.
+    """
+    el = el.previousSibling
+    while el is not None and not isinstance(el, Tag):
+        el = el.previousSibling
+    return el
+
+class Selector(object):
+
+    """
+    A compiled CSS selector. Elements are matched from right to left: an
+    element matches a group of the selector when it matches the last token
+    of the group and its ancestors and/or preceding siblings (depending on
+    the combinators) match the preceding tokens.
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        # Each group is a list of (combinator, checker, key) tuples.
+        self.groups = []
+        for group in (parse_selector(selector) or []):
+            steps = [(combinator, compile_token(token), index_key(token)) for combinator, token in group]
+            if any(checker is None for combinator, checker, key in steps):
+                # Unsupported selectors don't match anything.
+                self.groups = []
+                break
+            self.groups.append(steps)
+
+    def __repr__(self):
+        return "Selector(%r)" % self.selector
+
+    def match(self, element, root=None, memo=None):
+        """
+        Returns True when the element matches the selector. Only ancestors
+        below root are considered. When many elements of a document are
+        matched the same dictionary should be given as memo (it's used to
+        remember partial results, see match_related()).
+        """
+        if memo is None:
+            memo = {}
+        for steps in self.groups:
+            if self.match_step(steps, len(steps) - 1, element, root, memo):
+                return True
+        return False
+
+    def match_step(self, steps, i, element, root, memo):
+        """
+        Returns True when the element matches the i-th token of a group and
+        the tokens before it.
+        """
+        combinator, checker, key = steps[i]
+        if not checker(element):
+            return False
+        if i == 0:
+            return True
+        if combinator == '>':
+            node = element.parent
+            return node is not None and node is not root and \
+                    self.match_step(steps, i - 1, node, root, memo)
+        elif combinator == '+':
+            node = previous_element(element)
+            return node is not None and self.match_step(steps, i - 1, node, root, memo)
+        else:
+            return self.match_related(steps, i - 1, combinator, element, root, memo)
+
+    def match_related(self, steps, i, combinator, element, root, memo):
+        """
+        Returns True when an ancestor (for the ' ' combinator) or a preceding
+        sibling (for the '~' combinator) of the element matches the i-th token
+        of a group and the tokens before it. The answers are remembered for
+        the element and the nodes visited on the way, so that matching all
+        elements of a document takes linear time (instead of walking the
+        siblings of every element again).
+        """
+        visited = []
+        node = element
+        result = False
+        while True:
+            node = node.parent if combinator == ' ' else previous_element(node)
+            if node is None or node is root:
+                break
+            answer = memo.get((id(steps), i, id(node)))
+            if self.match_step(steps, i, node, root, memo):
+                result = True
+                break
+            visited.append(node)
+            if answer is not None:
+                result = answer
+                break
+        # The answer for each visited node follows from the nodes after it.
+        memo[(id(steps), i, id(element))] = result
+        for node in visited:
+            memo[(id(steps), i, id(node))] = result
+        return result
+
+    def iter_matches(self, soup):
+        """
+        Generates the descendants of soup that match the selector (in
+        document order).
+        """
+        if self.groups:
+            memo = {}
+            for el in soup.recursiveChildGenerator():
+                if isinstance(el, Tag) and self.match(el, soup, memo):
+                    yield el
+
+    def select(self, soup, index=None):
+        """
+        Returns a list of descendants of soup that match the selector (in
+        document order). When a DocumentIndex is given it's used to find the
+        elements matching each token of the selector (from left to right)
+        instead of scanning the document.
+        """
+        if index is None:
+            return list(self.iter_matches(soup))
+        found = {}
+        for steps in self.groups:
+            matches = [soup]
+            for combinator, checker, key in steps:
+                candidates = [el for el in index.lookup(key) if checker(el)]
+                if combinator in (None, ' '):
+                    matches = index.descendants(matches, candidates)
+                else:
+                    matches = index.related(combinator, matches, candidates)
+            for el in matches:
+                found[id(el)] = el
+        return sorted(found.values(), key=lambda el: index.positions[id(el)])
+
+# Cache of compiled selectors (the most recently used selector is last).
+selector_cache = collections.OrderedDict()
+
+def compile_selector(selector):
+    """
+    Compile a CSS selector into a Selector object. Compiled selectors are
+    kept in a cache (keyed by the selector string) of limited size; the
+    least recently used selectors are evicted first.
+    """
+    compiled = selector_cache.pop(selector, None)
+    if compiled is None:
+        compiled = Selector(selector)
+        if len(selector_cache) >= CACHE_SIZE:
+            selector_cache.popitem(last=False)
+    selector_cache[selector] = compiled
+    return compiled
+
+def select(soup, selector, index=None):
+    """
+    soup should be a BeautifulSoup instance; selector is a CSS selector 
+    specifying the elements you want to retrieve. The optional index is a
+    DocumentIndex of the document containing soup.
+    """
+    return compile_selector(selector).select(soup, index)
+
+def select_all(soup, selectors, index=None):
+    """
+    soup should be a BeautifulSoup instance; selectors is a list of CSS
+    selectors. Returns a list with the elements matching each selector,
+    found in a single traversal of the document (or using the optional
+    DocumentIndex).
+    """
+    if index is not None:
+        return [select(soup, selector, index) for selector in selectors]
+    compiled = [compile_selector(selector) for selector in selectors]
+    matches = [[] for selector in compiled]
+    memo = {}
+    for el in soup.recursiveChildGenerator():
+        if isinstance(el, Tag):
+            for selector, found in zip(compiled, matches):
+                if selector.match(el, soup, memo):
+                    found.append(el)
+    return matches
+
+def extract_all(soup, selectors, index=None):
+    """
+    soup should be a BeautifulSoup instance; selectors is a list of CSS
+    selectors. Removes the elements matching any of the selectors from the
+    document and returns them (in document order). The document is traversed
+    once and the descendants of matching elements are skipped (they're
+    removed along with their ancestor anyway). When a DocumentIndex is given
+    the matching elements are found using the index instead (the index is
+    out of date afterwards).
+    """
+    compiled = [compile_selector(selector) for selector in selectors]
+    compiled = [selector for selector in compiled if selector.groups]
+    if not compiled:
+        return []
+    matches = []
+    if index is not None:
+        found = {}
+        for selector in compiled:
+            for el in selector.select(soup, index):
+                found[id(el)] = el
+        candidates = sorted(found.values(), key=lambda el: index.positions[id(el)])
+        # Skip matches nested inside other matches.
+        for el in candidates:
+            if not (matches and index.descendants(matches[-1:], [el])):
+                matches.append(el)
+    else:
+        memo = {}
+        stack = [el for el in reversed(soup.contents) if isinstance(el, Tag)]
+        while stack:
+            el = stack.pop()
+            if any(selector.match(el, soup, memo) for selector in compiled):
+                matches.append(el)
+            else:
+                stack.extend(child for child in reversed(el.contents) if isinstance(child, Tag))
+    for el in matches:
+        el.extract()
+    return matches
 
 def monkeypatch(BeautifulSoupClass=None):
     """
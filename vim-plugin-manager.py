@@ -593,8 +593,11 @@ class VimPluginManager:
         directory = self.plugins[plugin_name]['directory']
         readme = os.path.join(directory, 'README.md')
         self.logger.info("Updating embedded documentation in %s ..", readme)
-        vimdoctool.embed_documentation(directory, readme, startlevel=3,
-                                       vfs=GitVFS(directory))
+        vfs = GitVFS(directory)
+        try:
+            vimdoctool.embed_documentation(directory, readme, startlevel=3, vfs=vfs)
+        finally:
+            vfs.close()
         run('git', 'add', 'README.md', cwd=directory)
 
     def run_html2vimdoc(self, plugin_name):
@@ -610,12 +613,17 @@ class VimPluginManager:
         self.logger.info("Converting %s to %s ..", readme, help_path)
         with open(readme) as handle:
             markdown = handle.read()
-        html = html2vimdoc.markdown_to_html(markdown, [])
-        vimdoc = html2vimdoc.html2vimdoc(html, filename=help_file)
+        # Most commits don't touch the documentation, so we use the
+        # conversion cache to avoid converting the same README.md again.
+        chunks = html2vimdoc.convert_document(markdown, markdown_extensions=[],
+                                              cache=html2vimdoc.ConversionCache(),
+                                              location=readme,
+                                              filename=help_file)
         if not os.path.isdir(help_dir):
             os.mkdir(help_dir)
-        with codecs.open(help_path, 'w', 'utf-8') as handle:
-            handle.write("%s\n" % vimdoc)
+        with html2vimdoc.atomic_write(help_path) as handle:
+            html2vimdoc.write_chunks(handle, chunks)
+            handle.write("\n")
         run('git', 'add', help_path, cwd=directory)
 
     ## Post-commit hooks.
@@ -756,19 +764,67 @@ class GitVFS(object):
     """
     Virtual file system interface which looks at the git HEAD of the master
     branch in the given directory.
+
+    The contents of files are read from the index through a single long lived
+    ``git cat-file --batch`` process (started on the first call to read()) so
+    that reading a lot of files doesn't require a new process per file. Call
+    close() when you're done with the VFS to terminate the process.
     """
 
-    def __init__(self, root):
+    def __init__(self, root, patterns=('*.vim',)):
         self.root = os.path.abspath(root)
+        self.patterns = patterns
+        self.process = None
+        self.blobs = {}
 
     def __str__(self):
         return "git master branch in %s" % self.root
 
     def list(self):
-        return run('git', 'ls-files', '--full-name', cwd=self.root, capture=True).splitlines()
+        # The pathspecs make git filter the files for us. The output of
+        # --stage includes the blob SHA1 of each file (see fingerprint()).
+        output = run('git', 'ls-files', '-z', '--stage', '--full-name', '--', *self.patterns, cwd=self.root, capture=True)
+        self.blobs = {}
+        for entry in output.split('\0'):
+            if entry:
+                metadata, filename = entry.split('\t', 1)
+                mode, blob, stage = metadata.split()
+                self.blobs[filename] = blob
+        return sorted(self.blobs)
 
     def read(self, filename):
-        return run('git', 'show', ':%s' % filename, cwd=self.root, capture=True)
+        if not self.process:
+            self.process = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                            cwd=self.root,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE)
+        self.process.stdin.write(':%s\n' % filename)
+        self.process.stdin.flush()
+        # The header line looks like "<sha1> blob <size>" or "<object> missing"
+        # (where the object name can contain spaces).
+        header = self.process.stdout.readline().split()
+        found = header and header[-1] not in ('missing', 'ambiguous') and len(header) == 3
+        if found:
+            contents = self.process.stdout.read(int(header[2]))
+            # Discard the newline that terminates the object contents.
+            self.process.stdout.read(1)
+        if not (found and header[1] == 'blob'):
+            msg = "Failed to read %s from git index (working directory: %s)"
+            raise ExternalCommandFailed(msg % (filename, self.root), ['git', 'cat-file', '--batch'])
+        return contents.strip()
+
+    def fingerprint(self, filename):
+        return self.blobs[filename]
+
+    def cache_file(self):
+        git_directory = run('git', 'rev-parse', '--git-dir', cwd=self.root, capture=True)
+        return os.path.join(self.root, git_directory, 'vimdoctool.cache')
+
+    def close(self):
+        if self.process:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
 
 def run(*args, **kw):
     """
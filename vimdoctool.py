@@ -7,7 +7,7 @@
 # URL: http://peterodding.com/code/vim/tools/
 
 """
-Usage: vim-doc-tool MARKDOWN_FILE
+Usage: vim-doc-tool [OPTIONS] MARKDOWN_FILE
 
 Extract the public functions and related comments (assumed to contain text in
 Markdown format) from the Vim scripts in and/or below the current working
@@ -21,9 +21,25 @@ command line. The embedding requires two markers in the Markdown document:
 
 These two markers make it possible for "vim-doc-tool" to replace its own output
 from previous runs.
+
+Supported options:
+
+  -j, --jobs=N    number of worker processes used to parse the Vim scripts
+                  when there are a lot of them (defaults to the number
+                  of CPUs)
+  -n, --no-cache  don't use the parse cache
+  -h, --help      show this message and exit
+
+The results of parsing each Vim script are cached in the .git directory of the
+repository (when there is one) so that later runs only have to parse the Vim
+scripts that changed since the previous run.
 """
 
 # Standard library modules.
+import cPickle
+import fnmatch
+import getopt
+import hashlib
 import logging
 import os
 import os.path
@@ -36,25 +52,55 @@ import time
 #       pip install coloredlogs
 import coloredlogs
 
+# Helpers shared with html2vimdoc.py (in the same directory).
+from html2vimdoc import atomic_write, parallel_map
+
 # Initialize the logging subsystem.
 logger = logging.getLogger('vimdoctool')
 logger.setLevel(logging.INFO)
 logger.addHandler(coloredlogs.ColoredStreamHandler(show_name=True))
 
+# Worker processes are only used when there's at least this much Vim script to
+# parse (in bytes): Starting a pool of worker processes takes about 0.1
+# seconds, which is about as long as it takes to parse a megabyte of Vim script.
+PARALLEL_THRESHOLD = 1024 * 1024
+
+# Directories that DefaultVFS never descends into.
+IGNORED_DIRECTORIES = ('.git', '.hg', '.svn', '.bzr', 'node_modules')
+
 # Compiled regular expressions used by parse_vim_script().
-function_pattern = re.compile(r'^function! ([^(]+)\(')
+function_pattern = re.compile(r'^\s*:?\s*fu(?:n|nc|nct|ncti|nctio|nction)?!?\s+([^(\s]+)\s*\(')
 comment_pattern = re.compile(r'^\s*"\s?(.*)$')
 
 def main():
     """
     Command line interface for vim-doc-tool.
     """
-    markdown_document = os.path.abspath(sys.argv[1])
+    jobs = None
+    use_cache = True
+    try:
+        options, arguments = getopt.getopt(sys.argv[1:], 'j:nh', ['jobs=', 'no-cache', 'help'])
+    except getopt.GetoptError, err:
+        print str(err)
+        print __doc__.strip()
+        sys.exit(1)
+    for option, value in options:
+        if option in ('-j', '--jobs'):
+            jobs = int(value)
+        elif option in ('-n', '--no-cache'):
+            use_cache = False
+        elif option in ('-h', '--help'):
+            print __doc__.strip()
+            sys.exit(0)
+    if len(arguments) != 1:
+        print __doc__.strip()
+        sys.exit(1)
+    markdown_document = os.path.abspath(arguments[0])
     directory = os.path.dirname(markdown_document)
-    embed_documentation(directory, markdown_document, startlevel=1)
+    embed_documentation(directory, markdown_document, startlevel=1, jobs=jobs, use_cache=use_cache)
     logger.info("Done!")
 
-def embed_documentation(directory, filename, startlevel=1, vfs=None):
+def embed_documentation(directory, filename, startlevel=1, vfs=None, jobs=1, use_cache=True):
     """
     Generate up-to-date documentation and embed the documentation in the given
     Markdown document, replacing any previously embedded documentation (based
@@ -71,7 +117,7 @@ def embed_documentation(directory, filename, startlevel=1, vfs=None):
         logger.warn("Markdown document %s doesn't contain start marker: %s", filename, doc_start)
         return
     # Extract documentation from Vim scripts.
-    documentation = generate_documentation(directory, startlevel=startlevel, vfs=vfs)
+    documentation = generate_documentation(directory, startlevel=startlevel, vfs=vfs, jobs=jobs, use_cache=use_cache)
     # Inject documentation into Markdown document.
     documentation = "\n\n".join([doc_start, documentation, doc_end])
     pattern = re.compile(re.escape(doc_start) + '.*?' + re.escape(doc_end), re.DOTALL)
@@ -80,20 +126,44 @@ def embed_documentation(directory, filename, startlevel=1, vfs=None):
     with open(filename, 'w') as handle:
         handle.write(pattern.sub(documentation, template))
 
-def generate_documentation(directory, startlevel=1, vfs=None):
+def generate_documentation(directory, startlevel=1, vfs=None, jobs=1, use_cache=True):
     """
     Generate documentation for Vim script functions by parsing the Vim scripts
     in and/or below the current working directory, looking for function
     definitions and extracting related comments (assumed to be in Markdown
     format).
+
+    The scripts are read through the VFS layer in this process and parsed by
+    ``jobs`` worker processes (all CPUs when ``jobs`` is None) when there's
+    enough to parse (see ``PARALLEL_THRESHOLD``). When
+    ``use_cache`` is True and the VFS layer supports it (see ``ParseCache``)
+    only the scripts that changed since the previous run are read and parsed.
     """
     scripts = []
     num_functions = 0
     # If the caller didn't specify a VFS layer, well use the default.
     if not vfs:
         vfs = DefaultVFS(directory)
-    for filename in sorted(find_vim_scripts(vfs), key=str.lower):
-        parse_results = parse_vim_script(vfs, filename)
+    filenames = sorted(find_vim_scripts(vfs), key=str.lower)
+    cache = ParseCache.for_vfs(vfs) if use_cache else None
+    results = {}
+    if cache:
+        for filename in filenames:
+            parse_results = cache.get(filename)
+            if parse_results is not None:
+                results[filename] = parse_results
+        logger.info("Reusing cached parse results of %i of %i Vim scripts.", len(results), len(filenames))
+    tasks = [(filename, vfs.read(filename)) for filename in filenames if filename not in results]
+    if sum(len(contents) for filename, contents in tasks) < PARALLEL_THRESHOLD:
+        jobs = 1
+    for (filename, contents), parse_results in zip(tasks, parallel_map(parse_script, tasks, jobs)):
+        results[filename] = parse_results
+        if cache:
+            cache.put(filename, parse_results)
+    if cache:
+        cache.save()
+    for filename in filenames:
+        parse_results = results[filename]
         if parse_results:
             num_functions += len(parse_results['functions'])
             scripts.append((filename, parse_results))
@@ -127,11 +197,107 @@ def find_vim_scripts(vfs):
             logger.debug("Found %s", filename)
             yield filename
 
+class ParseCache(object):
+
+    """
+    Persistent cache of the results of parse_vim_script(). Entries are keyed by
+    a fingerprint of each Vim script that's provided by the VFS layer (e.g. the
+    blob SHA1 in the git index or the modification time and size of a file)
+    and the cache is discarded when the source code of the parser changes.
+    The cache is stored in a single pickle file because the parse results
+    are byte strings in the encoding of the Vim script.
+    """
+
+    def __init__(self, pathname, vfs):
+        self.pathname = pathname
+        self.vfs = vfs
+        self.fingerprint = parser_fingerprint()
+        self.old_entries = {}
+        self.new_entries = {}
+        try:
+            with open(pathname, 'rb') as handle:
+                fingerprint, entries = cPickle.load(handle)
+            if fingerprint == self.fingerprint:
+                self.old_entries = entries
+            else:
+                logger.debug("Discarding parse cache %s (the parser changed).", pathname)
+        except Exception:
+            # A missing, truncated or incompatible cache is simply ignored.
+            pass
+
+    @staticmethod
+    def for_vfs(vfs):
+        """
+        Get the parse cache for the given VFS layer. Returns None when the VFS
+        layer doesn't implement the methods ``cache_file()`` and
+        ``fingerprint()`` or when it has no place to store the cache.
+        """
+        if hasattr(vfs, 'cache_file') and hasattr(vfs, 'fingerprint'):
+            pathname = vfs.cache_file()
+            if pathname:
+                return ParseCache(pathname, vfs)
+
+    def get(self, filename):
+        """
+        Get the cached parse results of the given Vim script. Returns None when
+        the Vim script isn't cached or changed since it was cached.
+        """
+        fingerprint = self.vfs.fingerprint(filename)
+        if filename in self.old_entries:
+            cached_fingerprint, parse_results = self.old_entries[filename]
+            if cached_fingerprint == fingerprint:
+                self.new_entries[filename] = (fingerprint, parse_results)
+                return parse_results
+
+    def put(self, filename, parse_results):
+        """
+        Add the parse results of the given Vim script to the cache.
+        """
+        self.new_entries[filename] = (self.vfs.fingerprint(filename), parse_results)
+
+    def save(self):
+        """
+        Save the cache. Only the entries that were used or added are saved, so
+        scripts that no longer exist are pruned from the cache.
+        """
+        if self.new_entries == self.old_entries:
+            return
+        try:
+            with atomic_write(self.pathname, 'wb') as handle:
+                cPickle.dump((self.fingerprint, self.new_entries), handle, cPickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError), e:
+            logger.warn("Failed to save parse cache %s: %s", self.pathname, e)
+
+def parser_fingerprint():
+    """
+    Get a hash of the source code of the parser (this module), so that cached
+    parse results are invalidated when the parser changes.
+    """
+    context = hashlib.sha1()
+    with open(os.path.splitext(__file__)[0] + '.py') as handle:
+        context.update(handle.read())
+    return context.hexdigest()
+
+def parse_script(task):
+    """
+    Worker function for generate_documentation(). Expects a tuple with the
+    filename and contents of a Vim script and parses the Vim script.
+    """
+    filename, contents = task
+    return parse_vim_source(filename, contents)
+
 def parse_vim_script(vfs, filename):
     """
-    Perform a very shallow parse of a Vim script file to find function
-    definitions and related comments. Returns a dictionary with the following
-    keys:
+    Read a Vim script file through the given VFS layer and parse it using
+    parse_vim_source().
+    """
+    return parse_vim_source(filename, vfs.read(filename))
+
+def parse_vim_source(filename, contents):
+    """
+    Perform a very shallow parse of the contents of a Vim script file to find
+    function definitions and related comments. Returns a dictionary with the
+    following keys:
 
     - synopsis: One line summary of purpose of Vim script
     - description: A paragraph or two explaining the purpose of the functions
@@ -140,51 +306,61 @@ def parse_vim_script(vfs, filename):
       and the related comments
     """
     parse_results = dict(functions=[])
-    lines = vfs.read(filename).splitlines()
+    lines = contents.splitlines()
     # Extract the prologue (a description of the functions in the script).
-    prologue = []
-    while lines:
-        line = lines.pop(0)
-        match = comment_pattern.match(line)
-        if not match:
-            break
-        text = match.group(1)
-        if ':' in text:
-            label, value = text.split(':', 1)
-            if label in ('Author', 'Last Change', 'URL'):
-                continue
-        prologue.append(text)
+    prologue, index = extract_comments(lines, 0)
+    prologue = [text for text in prologue if not is_header_field(text)]
     assert len(prologue) >= 1, "Failed to extract script prologue!"
     # Extract the one-line synopsis of the script's functions.
-    synopsis = prologue.pop(0).strip().rstrip('.')
-    while prologue and not prologue[0].strip():
-        prologue.pop(0)
+    synopsis = prologue[0].strip().rstrip('.')
+    offset = 1
+    while offset < len(prologue) and not prologue[offset].strip():
+        offset += 1
     logger.debug("Extracted synopsis: %s", synopsis)
     parse_results['synopsis'] = synopsis
-    parse_results['description'] = prologue
-    while lines:
-        line = lines.pop(0)
-        match = function_pattern.match(line)
+    parse_results['description'] = prologue[offset:]
+    # Scan the remaining lines for function definitions. Each line is visited
+    # once: The index only moves forward.
+    while index < len(lines):
+        match = function_pattern.match(lines[index])
+        index += 1
         if match:
             function_name = match.group(1)
             logger.debug("Found function: %s()", function_name)
             # Collect comments immediately following the function prologue.
-            logger.debug("Extracting comments:")
-            comments = []
-            while lines:
-                line = lines.pop(0)
-                match = comment_pattern.match(line)
-                if not match:
-                    break
-                text = match.group(1)
-                logger.debug("  %s", text)
-                comments.append(text)
+            comments, index = extract_comments(lines, index)
+            logger.debug("Extracted %i comment line(s).", len(comments))
             if is_public_function(function_name):
                 parse_results['functions'].append((function_name, comments))
     num_functions = len(parse_results['functions'])
     logger.info("Found %i function%s in %s.", num_functions, '' if num_functions == 1 else 's', filename)
     return parse_results
 
+def extract_comments(lines, index):
+    """
+    Extract the consecutive comment lines starting at the given index in a list
+    of lines. Returns a tuple with two values: A list with the text of the
+    comments and the index of the first line that isn't a comment.
+    """
+    comments = []
+    while index < len(lines):
+        match = comment_pattern.match(lines[index])
+        if not match:
+            break
+        comments.append(match.group(1))
+        index += 1
+    return comments, index
+
+def is_header_field(text):
+    """
+    Determine whether a line of the script prologue is one of the header fields
+    that shouldn't be included in the generated documentation.
+    """
+    if ':' in text:
+        label, value = text.split(':', 1)
+        return label in ('Author', 'Last Change', 'URL')
+    return False
+
 def is_public_function(function_name):
     """
     Determine whether the Vim script function with the given name is a public
@@ -201,25 +377,111 @@ class DefaultVFS(object):
     """
     Default virtual file system interface which simple looks at the working
     directory. Easy to replace with a VFS that looks at the git HEAD.
+
+    Only files with one of the given suffixes are listed. The directories in
+    ``ignored_directories`` and the files and directories excluded by
+    .gitignore files are skipped without descending into them.
     """
 
-    def __init__(self, root):
+    def __init__(self, root, suffixes=('.vim',), ignored_directories=IGNORED_DIRECTORIES):
         self.root = os.path.abspath(root)
+        self.suffixes = tuple(suffixes)
+        self.ignored_directories = set(ignored_directories)
 
     def __str__(self):
         return self.root
 
     def list(self):
-        for directory, dirs, files in os.walk(self.root):
-            for filename in files:
-                pathname = os.path.join(directory, filename)
-                yield os.path.relpath(pathname, self.root)
+        return self.walk(self.root, '', [])
+
+    def walk(self, directory, prefix, rules):
+        """
+        Recursively list the files in the given directory. The prefix is the
+        pathname of the directory relative to the root (ending in a slash) and
+        rules is the list of .gitignore rules that apply to the directory.
+        """
+        try:
+            entries = os.listdir(directory)
+        except OSError, e:
+            logger.warn("Failed to list directory %s: %s", directory, e)
+            return
+        if '.gitignore' in entries:
+            rules = rules + parse_gitignore(os.path.join(directory, '.gitignore'), prefix)
+        for name in sorted(entries):
+            pathname = os.path.join(directory, name)
+            relative_path = prefix + name
+            if name.endswith(self.suffixes) and os.path.isfile(pathname):
+                if not is_ignored(rules, relative_path, False):
+                    yield relative_path.replace('/', os.sep)
+            elif os.path.isdir(pathname) and not os.path.islink(pathname):
+                if name not in self.ignored_directories and not is_ignored(rules, relative_path, True):
+                    for filename in self.walk(pathname, relative_path + '/', rules):
+                        yield filename
 
     def read(self, filename):
         pathname = os.path.join(self.root, filename)
         with open(pathname) as handle:
             return handle.read()
 
+    def fingerprint(self, filename):
+        # The modification time and size of a file change when it's edited.
+        metadata = os.stat(os.path.join(self.root, filename))
+        return (metadata.st_mtime, metadata.st_size)
+
+    def cache_file(self):
+        git_directory = os.path.join(self.root, '.git')
+        if os.path.isdir(git_directory):
+            return os.path.join(git_directory, 'vimdoctool.cache')
+
+def parse_gitignore(filename, prefix):
+    """
+    Parse a .gitignore file into a list of rules. Each rule is a tuple with four
+    values: A compiled regular expression, whether the rule re-includes files,
+    whether it only applies to directories and whether the pattern is matched
+    against the relative pathname (instead of the base name). The prefix is
+    the pathname of the directory containing the .gitignore file relative to
+    the root of the VFS (ending in a slash). This supports the commonly used
+    subset of the .gitignore syntax; wildcards in patterns that contain a
+    slash can match slashes.
+    """
+    rules = []
+    try:
+        with open(filename) as handle:
+            lines = handle.read().splitlines()
+    except IOError:
+        return rules
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        directory_only = line.endswith('/')
+        line = line.rstrip('/')
+        if line.startswith('**/') and '/' not in line[3:]:
+            line = line[3:]
+        anchored = '/' in line
+        if anchored:
+            line = prefix + line.lstrip('/')
+        if line:
+            rules.append((re.compile(fnmatch.translate(line)), negate, directory_only, anchored))
+    return rules
+
+def is_ignored(rules, relative_path, is_directory):
+    """
+    Check whether the given pathname is excluded by a list of .gitignore rules
+    (see parse_gitignore()). Like git, the last matching rule wins.
+    """
+    ignored = False
+    name = relative_path.rsplit('/', 1)[-1]
+    for pattern, negate, directory_only, anchored in rules:
+        if directory_only and not is_directory:
+            continue
+        if pattern.match(relative_path if anchored else name):
+            ignored = not negate
+    return ignored
+
 def wrap(text):
     """
     Hard wrap a paragraph of text.